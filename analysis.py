@@ -0,0 +1,326 @@
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from parser import ChartColumns, NoteInfo, Note
+from typing import Any, Iterable, Optional
+import argparse
+import json
+import os
+import sys
+import numpy as np
+
+# Chart analysis shared by the renderer and stats jobs. Nothing here depends on Skia.
+
+DEFAULT_WINDOWS = (1.0, 5.0)
+
+
+def _time_order(chart: ChartColumns) -> np.ndarray:
+    # Note indices in the order the renderer sees them, sorted by time and stable on parse order
+    return np.argsort(chart.time, kind='stable')
+
+
+def _accumulate_bars(start: float, delta: float, limit: float) -> list[float]:
+    # start + delta, start + 2 * delta, ... below limit, added up one bar at a time like a running sum would
+    if not start + delta < limit:
+        return []
+    count = int((limit - start) / delta) + 2
+    while True:
+        steps = np.full(count + 1, delta, dtype=np.float64)
+        steps[0] = start
+        values = np.add.accumulate(steps)[1:]
+        if values[-1] >= limit:
+            break
+        count *= 2
+    return values[:np.searchsorted(values, limit, side='left')].tolist()
+
+
+def analyze_beat_lines(chart: NoteInfo | ChartColumns, max_time: Optional[float] = None) -> list[float]:
+    if isinstance(chart, ChartColumns):
+        indices = np.flatnonzero(chart.note_type == 2)
+        bpm_changes = list(zip(chart.time[indices].tolist(), chart.change_bpm[indices].tolist()))
+        max_time = float(chart.time.max()) if max_time is None else max_time
+    else:
+        bpm_changes = [(x.time, x.change_bpm) for x in chart.notes if x.note_type == 2]
+        max_time = max(x.time for x in chart.notes) if max_time is None else max_time
+    curr_bpm = chart.bpm
+    curr_time = 0.0
+    timings: list[float] = []
+    for change_time, change_bpm in bpm_changes:
+        timings += _accumulate_bars(curr_time, 60 / curr_bpm * 4, change_time)
+        curr_bpm = change_bpm
+        timings.append(change_time)
+        curr_time = change_time
+    timings += _accumulate_bars(curr_time, 60 / curr_bpm * 4, max_time)
+    return timings
+
+
+def _playable_notes(notes: list[Note] | ChartColumns) -> tuple[list, np.ndarray, np.ndarray, np.ndarray]:
+    # Non-meta notes (indices for ChartColumns, taken in time order) with their times, BPMs and positions
+    if isinstance(notes, ChartColumns):
+        order = _time_order(notes)
+        order = order[notes.note_type[order] >= 10]
+        return order.tolist(), notes.time[order], notes.note_bpm[order], notes.position[order]
+    items = [x for x in notes if not x.is_meta_note()]
+    times = np.array([x.time for x in items], dtype=np.float64)
+    bpms = np.array([x.bpm for x in items], dtype=np.float64)
+    positions = np.array([x.position for x in items], dtype=np.float64)
+    return items, times, bpms, positions
+
+
+def analyze_coincident_lines(notes: list[Note] | ChartColumns) -> list[tuple[float, list]]:
+    # For ChartColumns the lists hold note indices instead of Note objects
+    items, times, _, positions = _playable_notes(notes)
+    if not items:
+        return []
+    _, first_index, group, counts = np.unique(times, return_index=True, return_inverse=True, return_counts=True)
+    group = group.reshape(-1)
+    # Lines come in order of first appearance, notes on a line by position and then by appearance
+    group_rank = np.empty_like(first_index)
+    group_rank[np.argsort(first_index, kind='stable')] = np.arange(len(first_index))
+    selected = np.flatnonzero(counts[group] >= 2)
+    selected = selected[np.lexsort((selected, positions[selected], group_rank[group[selected]]))]
+    splits = np.flatnonzero(np.diff(group[selected])) + 1
+    result: list[tuple[float, list]] = []
+    for line in np.split(selected, splits) if len(selected) else []:
+        indices = line.tolist()
+        result.append((float(times[first_index[group[indices[0]]]]), [items[i] for i in indices]))
+    return result
+
+
+def analyze_beats(notes: list | ChartColumns) -> list[tuple[float, int]]:
+    _, times, bpms, _ = _playable_notes(notes)
+    if len(times) < 2:
+        return []
+    # The BPM of a timing is the one of its last note
+    timings, last_index = np.unique(times[::-1], return_index=True)
+    timing_bpm = bpms[::-1][last_index]
+    error_tolerance: float = 0.05
+    time_delta = 60.0 / timing_bpm[:-1] * 4
+    nxt = time_delta / np.diff(timings)
+    beat = np.rint(nxt)
+    beat = np.where(np.abs(nxt - beat) < error_tolerance, np.maximum(beat, 0), 0).astype(np.int64)
+    keep = np.flatnonzero((beat % 2 == 0) & (beat != 0))
+    return list(zip(timings[keep].tolist(), beat[keep].tolist()))
+
+
+class ComboIndex:
+    times: np.ndarray
+
+    def __init__(self, notes: list[Note] | ChartColumns) -> None:
+        if isinstance(notes, ChartColumns):
+            self.times = np.sort(notes.time[notes.note_type >= 10])
+        else:
+            self.times = np.sort(np.array([x.time for x in notes if not x.is_meta_note()], dtype=np.float64))
+
+    @classmethod
+    def from_chart(cls, chart: NoteInfo | ChartColumns) -> "ComboIndex":
+        return cls(chart if isinstance(chart, ChartColumns) else chart.notes)
+
+    def total(self) -> int:
+        return len(self.times)
+
+    def combo_before(self, time: float) -> int:
+        return int(np.searchsorted(self.times, time, side='left'))
+
+    def combo_before_many(self, times) -> np.ndarray:
+        return np.searchsorted(self.times, np.asarray(times, dtype=np.float64), side='left')
+
+
+class ChartStats:
+    # Per-chart metrics, see analyze_chart. Times are in seconds, bars start at 0 and at every bar line.
+    note_count: int
+    duration: float
+    bar_times: list[float]
+    notes_per_bar: list[int]
+    combo_at_bar: list[int]
+    peak_nps: dict[float, tuple[float, float]]
+    chords: dict[int, int]
+    charge_count: int
+    charge_seconds: float
+    chain_count: int
+    chain_seconds: float
+    bpm_segments: list[tuple[float, float]]
+    speed_segments: list[tuple[float, float]]
+    combo: ComboIndex
+
+    @property
+    def average_nps(self) -> float:
+        return self.note_count / self.duration if self.duration > 0 else 0.0
+
+    def coverage(self, seconds: float) -> float:
+        return seconds / self.duration if self.duration > 0 else 0.0
+
+    def combo_at(self, time: float) -> int:
+        # Notes judged before time
+        return self.combo.combo_before(time)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            'notes': self.note_count,
+            'duration': self.duration,
+            'average_nps': self.average_nps,
+            'peak_nps': {'{:g}'.format(k): {'nps': v[0], 'time': v[1]} for k, v in self.peak_nps.items()},
+            'bar_times': self.bar_times,
+            'notes_per_bar': self.notes_per_bar,
+            'combo_at_bar': self.combo_at_bar,
+            'chords': {str(k): v for k, v in self.chords.items()},
+            'charge': {'count': self.charge_count, 'seconds': self.charge_seconds,
+                       'coverage': self.coverage(self.charge_seconds)},
+            'chain': {'count': self.chain_count, 'seconds': self.chain_seconds,
+                      'coverage': self.coverage(self.chain_seconds)},
+            'bpm_segments': [list(x) for x in self.bpm_segments],
+            'speed_segments': [list(x) for x in self.speed_segments],
+        }
+
+
+def _chart_arrays(chart: NoteInfo | ChartColumns) -> tuple[np.ndarray, np.ndarray, list[int], np.ndarray]:
+    # Times, note types, next note indices (-1 if none) and type argument values of meta notes
+    if isinstance(chart, ChartColumns):
+        values = np.where(chart.note_type == 2, chart.change_bpm, chart.time_scale)
+        return chart.time, chart.note_type, chart.next_index.tolist(), values
+    notes = chart.notes
+    index = {id(x): i for i, x in enumerate(notes)}
+    times = np.array([x.time for x in notes], dtype=np.float64)
+    note_type = np.array([x.note_type for x in notes], dtype=np.int16)
+    next_index = [index[id(x.next_note)] if x.next_note is not None else -1 for x in notes]
+    values = np.array([x.change_bpm if x.note_type == 2 else x.time_scale if x.note_type == 3 else None
+                       for x in notes], dtype=np.float64)
+    return times, note_type, next_index, values
+
+
+def _group_spans(times: np.ndarray, note_type: np.ndarray, next_index: list[int],
+                 heads: tuple[int, ...]) -> list[tuple[float, float]]:
+    # Start and end time of every charge or chain group, following the links from its begin note
+    spans: list[tuple[float, float]] = []
+    for i in np.flatnonzero(np.isin(note_type, heads)).tolist():
+        end = i
+        while next_index[end] >= 0:
+            end = next_index[end]
+        spans.append((float(times[i]), float(times[end])))
+    return spans
+
+
+def _covered_seconds(spans: list[tuple[float, float]]) -> float:
+    # Length of the union of the spans, overlapping groups are only counted once
+    total = 0.0
+    current: Optional[list[float]] = None
+    for start, end in sorted(spans):
+        if current is not None and start <= current[1]:
+            current[1] = max(current[1], end)
+            continue
+        if current is not None:
+            total += current[1] - current[0]
+        current = [start, end]
+    if current is not None:
+        total += current[1] - current[0]
+    return total
+
+
+def _peak_rate(times: np.ndarray, window: float) -> tuple[float, float]:
+    # Highest number of notes in any window seconds long per second, and where that window starts
+    if not len(times):
+        return 0.0, 0.0
+    counts = np.searchsorted(times, times + window, side='left') - np.arange(len(times))
+    k = int(np.argmax(counts))
+    return float(counts[k]) / window, float(times[k])
+
+
+def _segments(initial: float, change_times: list[float], change_values: list[float]) -> list[tuple[float, float]]:
+    # Segments from time 0 on, a change at the same time as the segment before it replaces that segment's value,
+    # as the last change at a time is the one that applies
+    segments = [(0.0, initial)]
+    for time, value in zip(change_times, change_values):
+        if time == segments[-1][0]:
+            segments[-1] = (time, value)
+        else:
+            segments.append((time, value))
+    return segments
+
+
+def analyze_chart(chart: NoteInfo | ChartColumns, windows: Iterable[float] = DEFAULT_WINDOWS) -> ChartStats:
+    stats = ChartStats()
+    times, note_type, next_index, values = _chart_arrays(chart)
+    _, playable_times, _, _ = _playable_notes(chart if isinstance(chart, ChartColumns) else chart.notes)
+    stats.combo = ComboIndex.from_chart(chart)
+    stats.note_count = len(playable_times)
+    stats.duration = float(playable_times[-1]) if len(playable_times) else 0.0
+    # Bars
+    # Bar lines include BPM changes, which may coincide with time 0 or with each other. Each time starts one bar.
+    bar_times = [0.0] + (analyze_beat_lines(chart) if len(times) else [])
+    stats.bar_times = [x for i, x in enumerate(bar_times) if i == 0 or x != bar_times[i - 1]]
+    bar_starts = np.searchsorted(playable_times, stats.bar_times, side='left')
+    stats.notes_per_bar = np.diff(np.append(bar_starts, len(playable_times))).tolist()
+    stats.combo_at_bar = stats.combo.combo_before_many(stats.bar_times).tolist()
+    # Density and chords
+    stats.peak_nps = {float(x): _peak_rate(playable_times, float(x)) for x in windows}
+    stats.chords = dict(sorted(Counter(len(notes) for _, notes in analyze_coincident_lines(
+        chart if isinstance(chart, ChartColumns) else chart.notes)).items()))
+    # Charge and chain groups
+    charge_spans = _group_spans(times, note_type, next_index, (20, 50))
+    chain_spans = _group_spans(times, note_type, next_index, (30,))
+    stats.charge_count, stats.charge_seconds = len(charge_spans), _covered_seconds(charge_spans)
+    stats.chain_count, stats.chain_seconds = len(chain_spans), _covered_seconds(chain_spans)
+    # BPM and speed segments, each starting at its change
+    order = np.argsort(times, kind='stable')
+    bpm_changes = order[note_type[order] == 2]
+    speed_changes = order[note_type[order] == 3]
+    stats.bpm_segments = _segments(chart.bpm, times[bpm_changes].tolist(), values[bpm_changes].tolist())
+    stats.speed_segments = _segments(1.0, times[speed_changes].tolist(), values[speed_changes].tolist())
+    return stats
+
+
+def analyze_charts(charts: Iterable[NoteInfo | ChartColumns],
+                   windows: Iterable[float] = DEFAULT_WINDOWS) -> list[ChartStats]:
+    windows = tuple(windows)
+    return [analyze_chart(x, windows) for x in charts]
+
+
+def _analyze_file(path: str, windows: tuple[float, ...]) -> dict[str, Any]:
+    # Only file loading needs the chart file module, analysis of parsed charts does not import it
+    from chartfile import load_columns
+    try:
+        return {'path': path, 'stats': analyze_chart(load_columns(path), windows).to_dict()}
+    except Exception as e:
+        return {'path': path, 'error': '{}: {}'.format(type(e).__name__, e)}
+
+
+def analyze_files(paths: Iterable[str], windows: Iterable[float] = DEFAULT_WINDOWS,
+                  workers: Optional[int] = None) -> list[dict[str, Any]]:
+    # Chart JSON or binary chart files, analyzed on a process pool. Failures are reported per file under 'error'.
+    paths = list(paths)
+    windows = tuple(windows)
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(paths) < 2:
+        return [_analyze_file(x, windows) for x in paths]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_analyze_file, paths, [windows] * len(paths),
+                                 chunksize=max(1, len(paths) // (workers * 4))))
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    arg_parser = argparse.ArgumentParser(description='Compute statistics of ChainBeeT charts.')
+    arg_parser.add_argument('source', nargs='+', help='chart JSON or binary chart files, or directories of them')
+    arg_parser.add_argument('-w', '--window', type=float, action='append',
+                            help='peak NPS window in seconds, may be repeated (default: 1 and 5)')
+    arg_parser.add_argument('-j', '--workers', type=int, default=None, help='worker processes (default: CPU count)')
+    arg_parser.add_argument('-o', '--output', default=None, help='write results as JSON to this path')
+    args = arg_parser.parse_args(argv)
+    from chartfile import EXTENSION
+    paths: list[str] = []
+    for source in args.source:
+        if os.path.isdir(source):
+            paths += sorted(os.path.join(root, x) for root, _, files in os.walk(source)
+                            for x in files if x.endswith('.json') or x.endswith(EXTENSION))
+        else:
+            paths.append(source)
+    results = analyze_files(paths, args.window or DEFAULT_WINDOWS, args.workers)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+    return 1 if any('error' in x for x in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
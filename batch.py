@@ -0,0 +1,252 @@
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from parser import parse
+from renderer import ChainbeetRenderer, ChainbeetRenderConfig, ChainbeetPaints
+from typing import Iterable, Optional
+import argparse
+import json
+import os
+import signal
+import sys
+import threading
+import time
+import skia as sk
+
+VARIANTS = ('normal', 'mirror')
+
+
+class BatchJob:
+    path: str
+    output: str
+    name: Optional[str]
+
+    def __init__(self, path: str, output: str, name: Optional[str] = None) -> None:
+        self.path = path
+        self.output = output
+        self.name = name
+
+    def output_path(self, variant: str) -> str:
+        return self.output + '.png' if variant == 'normal' else '{}.{}.png'.format(self.output, variant)
+
+
+class BatchResult:
+    path: str
+    variant: str
+    output: Optional[str]
+    error: Optional[str]
+    seconds: float
+
+    def __init__(self, path: str, variant: str, output: Optional[str], error: Optional[str], seconds: float) -> None:
+        self.path = path
+        self.variant = variant
+        self.output = output
+        self.error = error
+        self.seconds = seconds
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class BatchSummary:
+    results: list[BatchResult]
+    elapsed: float
+    workers: int
+
+    def __init__(self, results: list[BatchResult], elapsed: float, workers: int) -> None:
+        self.results = results
+        self.elapsed = elapsed
+        self.workers = workers
+
+    @property
+    def failures(self) -> list[BatchResult]:
+        return [x for x in self.results if not x.ok]
+
+    @property
+    def chart_count(self) -> int:
+        return len(set(x.path for x in self.results))
+
+    def format(self) -> str:
+        succeeded = len(self.results) - len(self.failures)
+        rate = succeeded / self.elapsed if self.elapsed > 0 else 0.0
+        busy = sum(x.seconds for x in self.results if x.ok)
+        lines = ['{} charts, {} images rendered, {} failed in {:.2f}s with {} workers ({:.2f} images/s, {:.3f}s per image)'
+                 .format(self.chart_count, succeeded, len(self.failures), self.elapsed, self.workers, rate,
+                         busy / succeeded if succeeded else 0.0)]
+        for failure in self.failures:
+            lines.append('  FAILED {} [{}]: {}'.format(failure.path, failure.variant, failure.error))
+        return '\n'.join(lines)
+
+
+def collect_jobs(source: str, output_dir: str) -> list[BatchJob]:
+    # source is either a directory searched recursively for *.json charts, or a JSON manifest holding a list of
+    # chart paths or {"path": ..., "name": ...} objects, relative to the manifest
+    jobs: list[BatchJob] = []
+    if os.path.isdir(source):
+        for root, _, files in os.walk(source):
+            for file in sorted(files):
+                if file.endswith('.json'):
+                    path = os.path.join(root, file)
+                    rel = os.path.splitext(os.path.relpath(path, source))[0]
+                    jobs.append(BatchJob(path, os.path.join(output_dir, rel)))
+        jobs.sort(key=lambda x: x.path)
+        return jobs
+    base = os.path.dirname(source)
+    with open(source, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    for entry in manifest:
+        if isinstance(entry, str):
+            entry = {'path': entry}
+        path = os.path.join(base, entry['path'])
+        output = entry.get('output', os.path.splitext(entry['path'])[0])
+        jobs.append(BatchJob(path, os.path.join(output_dir, output), entry.get('name')))
+    return jobs
+
+
+_worker_paints: Optional[ChainbeetPaints] = None
+_worker_config: Optional[ChainbeetRenderConfig] = None
+
+
+def _init_worker(config: Optional[ChainbeetRenderConfig]):
+    # Skia objects can not cross process boundaries, every worker builds its own once
+    global _worker_paints, _worker_config
+    _worker_paints = ChainbeetPaints()
+    _worker_config = config
+
+
+class _ChartTimeout(Exception):
+    pass
+
+
+def _raise_timeout(signum, frame):
+    raise _ChartTimeout()
+
+
+def _render_job(job: BatchJob, variants: tuple[str, ...], timeout: Optional[float]) -> list[BatchResult]:
+    if _worker_paints is None:
+        _init_worker(_worker_config)
+    # Signal handlers can only be installed from the main thread, elsewhere charts run without a timeout
+    use_alarm = timeout is not None and hasattr(signal, 'setitimer') and \
+        threading.current_thread() is threading.main_thread()
+    previous_handler = None
+    if use_alarm:
+        previous_handler = signal.signal(signal.SIGALRM, _raise_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    results: list[BatchResult] = []
+    try:
+        with open(job.path, 'r', encoding='utf-8') as f:
+            chart_json = f.read()
+        for variant in variants:
+            begin = time.perf_counter()
+            output = job.output_path(variant)
+            try:
+                chart = parse(chart_json, variant == 'mirror')
+                image = ChainbeetRenderer(chart, _worker_config, chart_name=job.name, paints=_worker_paints).render()
+                os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+                with open(output, 'wb') as f:
+                    image.save(f, sk.EncodedImageFormat.kPNG)
+                results.append(BatchResult(job.path, variant, output, None, time.perf_counter() - begin))
+            except _ChartTimeout:
+                raise
+            except Exception as e:
+                results.append(BatchResult(job.path, variant, None, '{}: {}'.format(type(e).__name__, e),
+                                           time.perf_counter() - begin))
+    except _ChartTimeout:
+        done = set(x.variant for x in results)
+        results += [BatchResult(job.path, x, None, 'timed out after {:g}s'.format(timeout), 0.0)
+                    for x in variants if x not in done]
+    except Exception as e:
+        results = [BatchResult(job.path, x, None, '{}: {}'.format(type(e).__name__, e), 0.0) for x in variants]
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous_handler)
+    return results
+
+
+def _crashed(job: BatchJob, error: BaseException, variants: tuple[str, ...]) -> list[BatchResult]:
+    return [BatchResult(job.path, x, None, 'worker crashed: {}'.format(error), 0.0) for x in variants]
+
+
+def _render_isolated(jobs: list[BatchJob], variants: tuple[str, ...], timeout: Optional[float],
+                     config: Optional[ChainbeetRenderConfig]) -> list[BatchResult]:
+    # Every job gets a pool of its own, so a crash is only reported for the chart that caused it
+    pools = [ProcessPoolExecutor(max_workers=1, initializer=_init_worker, initargs=(config,)) for _ in jobs]
+    results: list[BatchResult] = []
+    try:
+        futures = [pool.submit(_render_job, job, variants, timeout) for pool, job in zip(pools, jobs)]
+        for job, future in zip(jobs, futures):
+            try:
+                results += future.result()
+            except BrokenProcessPool as e:
+                results += _crashed(job, e, variants)
+    finally:
+        for pool in pools:
+            pool.shutdown()
+    return results
+
+
+def render_batch(
+    jobs: Iterable[BatchJob],
+    variants: Iterable[str] = ('normal',),
+    workers: Optional[int] = None,
+    timeout: Optional[float] = None,
+    config: Optional[ChainbeetRenderConfig] = None
+) -> BatchSummary:
+    jobs = list(jobs)
+    variants = tuple(variants)
+    for variant in variants:
+        if variant not in VARIANTS:
+            raise ValueError('unknown variant: {}'.format(variant))
+    workers = workers or os.cpu_count() or 1
+    begin = time.perf_counter()
+    results: list[BatchResult] = []
+    if workers == 1:
+        _init_worker(config)
+        for job in jobs:
+            results += _render_job(job, variants, timeout)
+        return BatchSummary(results, time.perf_counter() - begin, workers)
+    # At most one job per worker is submitted at a time. When a worker dies the whole pool breaks and every job on
+    # it fails with it, those are rerun in isolation to find the culprit and the rest continue on a fresh pool.
+    pending = deque(jobs)
+    while pending:
+        suspects: list[tuple[BatchJob, BrokenProcessPool]] = []
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(config,)) as executor:
+            running: dict[Future, BatchJob] = {}
+            while running or (pending and not suspects):
+                while pending and not suspects and len(running) < workers:
+                    job = pending.popleft()
+                    running[executor.submit(_render_job, job, variants, timeout)] = job
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    try:
+                        results += future.result()
+                    except BrokenProcessPool as e:
+                        suspects.append((job, e))
+        if len(suspects) == 1:
+            results += _crashed(*suspects[0], variants)
+        elif suspects:
+            results += _render_isolated([x for x, _ in suspects], variants, timeout, config)
+    results.sort(key=lambda x: (x.path, variants.index(x.variant)))
+    return BatchSummary(results, time.perf_counter() - begin, workers)
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    arg_parser = argparse.ArgumentParser(description='Render ChainBeeT charts to PNG in bulk.')
+    arg_parser.add_argument('source', help='directory of chart JSON files, or a JSON manifest listing them')
+    arg_parser.add_argument('-o', '--output', default='output', help='output directory')
+    arg_parser.add_argument('-v', '--variant', action='append', choices=VARIANTS,
+                            help='variant to render, may be repeated (default: normal)')
+    arg_parser.add_argument('-j', '--workers', type=int, default=None, help='worker processes (default: CPU count)')
+    arg_parser.add_argument('-t', '--timeout', type=float, default=None, help='per-chart timeout in seconds')
+    args = arg_parser.parse_args(argv)
+    jobs = collect_jobs(args.source, args.output)
+    summary = render_batch(jobs, args.variant or ('normal',), args.workers, args.timeout)
+    print(summary.format())
+    return 1 if summary.failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,269 @@
+from analysis import analyze_beat_lines, analyze_beats, analyze_coincident_lines
+from parser import parse, parse_columns
+from renderer import ChainbeetRenderer
+from typing import Any, Callable, Optional
+import argparse
+import gc
+import json
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+import skia as sk
+
+_POSITION_SPLIT = 7
+_BEAT_SPLITS = (4, 8, 12, 16, 24)
+
+
+class ChartSpec:
+    # Parameters of a synthetic chart. Group counts are numbers of charge / chain groups, the rest are notes.
+    name: str
+    seed: int
+    notes: int
+    bpm_changes: int
+    speed_changes: int
+    charge_groups: int
+    chain_groups: int
+    duration: float
+    bpm: float
+
+    def __init__(
+        self,
+        name: str,
+        seed: int = 0,
+        notes: int = 1500,
+        bpm_changes: int = 0,
+        speed_changes: int = 0,
+        charge_groups: int = 10,
+        chain_groups: int = 40,
+        duration: float = 120.0,
+        bpm: float = 150.0
+    ) -> None:
+        self.name = name
+        self.seed = seed
+        self.notes = notes
+        self.bpm_changes = bpm_changes
+        self.speed_changes = speed_changes
+        self.charge_groups = charge_groups
+        self.chain_groups = chain_groups
+        self.duration = duration
+        self.bpm = bpm
+
+    def to_dict(self) -> dict[str, Any]:
+        return dict(self.__dict__)
+
+
+PRESETS = {
+    'small': ChartSpec('small', notes=500, charge_groups=5, chain_groups=10, duration=90.0),
+    'medium': ChartSpec('medium', notes=1500, bpm_changes=4, speed_changes=8, charge_groups=20, chain_groups=40),
+    'dense': ChartSpec('dense', notes=4000, bpm_changes=10, speed_changes=60, charge_groups=60, chain_groups=150,
+                       duration=180.0, bpm=180.0),
+    'long': ChartSpec('long', notes=3000, bpm_changes=20, speed_changes=200, charge_groups=40, chain_groups=80,
+                      duration=600.0),
+}
+
+
+def generate_chart(spec: ChartSpec) -> dict[str, Any]:
+    # Generates a ChainBeeT chart JSON object. Notes are laid out on whole bars at the base BPM, so BPM changes
+    # stretch or shrink the real duration somewhat.
+    rng = random.Random(spec.seed)
+    bars = max(2, int(spec.duration * spec.bpm / 240))
+
+    def beat_at():
+        beat_split = rng.choice(_BEAT_SPLITS)
+        return [rng.randrange(1, bars), beat_split, rng.randrange(beat_split)]
+
+    def note(beat, note_type, *args):
+        return [beat[0], _POSITION_SPLIT, beat[1], rng.randrange(_POSITION_SPLIT), beat[2], note_type, *args]
+
+    notes: list[list] = [[0, 2, 1, 0, 0, 1, 'bgm']]
+    for _ in range(spec.bpm_changes):
+        notes.append([rng.randrange(1, bars), 2, 4, 0, rng.randrange(4), 2, round(rng.uniform(0.6, 1.5) * spec.bpm, 1)])
+    for _ in range(spec.speed_changes):
+        notes.append([rng.randrange(1, bars), 2, 4, 0, rng.randrange(4), 3, rng.choice((0.5, 0.75, 1, 1.5, 2))])
+    group = 0
+    for _ in range(spec.charge_groups):
+        start = rng.randrange(1, bars - 1)
+        length = rng.randint(1, 4)
+        notes.append(note([start, 4, 0], 20, group))
+        for k in range(1, length):
+            notes.append(note([start, 4, k], 22, group))
+        notes.append(note([start + 1, 4, 0], 21, group))
+        group += 1
+    for _ in range(spec.chain_groups):
+        start = rng.randrange(1, bars - 1)
+        length = rng.randint(2, 8)
+        notes.append(note([start, 16, 0], 30, group))
+        for k in range(1, length - 1):
+            notes.append(note([start, 16, k], 31, group))
+        notes.append(note([start, 16, length - 1], 32, group))
+        group += 1
+    while len(notes) < spec.notes:
+        if rng.random() < 0.05:
+            notes.append(note(beat_at(), 40, rng.choice((0.2, 0.3, 0.5))))
+        else:
+            notes.append(note(beat_at(), 10))
+    rng.shuffle(notes)
+    return {'info': {'bpm': spec.bpm, 'delay': 0, 'dir': 'Sound/{}/'.format(spec.name)}, 'notes': notes}
+
+
+def _rss_kb() -> tuple[Optional[int], Optional[int]]:
+    # Current and peak resident set size of this process, only available where /proc is
+    try:
+        with open('/proc/self/status', 'r') as f:
+            fields = dict(x.split(':', 1) for x in f)
+        return int(fields['VmRSS'].split()[0]), int(fields['VmHWM'].split()[0])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _reset_peak_rss() -> bool:
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _measure_rss(func: Callable[[], Any]) -> tuple[Optional[int], Optional[int]]:
+    # Growth of the peak and of the retained resident set over one run. Unlike tracemalloc this includes native
+    # allocations such as Skia surfaces. The peak is reset before the run, so it is the stage's own peak rather
+    # than the highest one so far in the process.
+    gc.collect()
+    before, _ = _rss_kb()
+    if before is None or not _reset_peak_rss():
+        return None, None
+    # The result is still referenced when the resident set is read, so it counts as retained
+    result = func()
+    after, peak = _rss_kb()
+    del result
+    return max(0, peak - before), after - before
+
+
+def _measure(func: Callable[[], Any], repeat: int) -> tuple[Any, dict[str, Any]]:
+    samples: list[float] = []
+    result = None
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        result = func()
+        samples.append(time.perf_counter() - begin)
+    # Allocations are traced in a separate run, tracemalloc slows Python code down considerably. It only sees the
+    # Python heap, so the resident set is measured in one more run of its own.
+    tracemalloc.start()
+    func()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss_peak, rss_retained = _measure_rss(func)
+    return result, {
+        'seconds_min': min(samples),
+        'seconds_median': statistics.median(samples),
+        'alloc_peak_bytes': peak,
+        'alloc_retained_bytes': current,
+        'rss_peak_kb': rss_peak,
+        'rss_retained_kb': rss_retained,
+    }
+
+
+def benchmark_chart(chart_json: str, repeat: int = 3) -> dict[str, dict[str, Any]]:
+    stages: dict[str, dict[str, Any]] = {}
+    chart, stages['parse'] = _measure(lambda: parse(chart_json), repeat)
+    _, stages['parse_columns'] = _measure(lambda: parse_columns(chart_json), repeat)
+    notes = sorted(chart.notes, key=lambda x: x.time)
+    beat_lines, stages['analyze_beat_lines'] = _measure(lambda: analyze_beat_lines(chart), repeat)
+    _, stages['analyze_coincident_lines'] = _measure(lambda: analyze_coincident_lines(notes), repeat)
+    _, stages['analyze_beats'] = _measure(lambda: analyze_beats(notes), repeat)
+    renderer = ChainbeetRenderer(chart)
+    times = [x.time for x in notes]
+    _, stages['compute_time_y'] = _measure(lambda: [renderer.compute_time_y(x) for x in times], repeat)
+    _, stages['get_combo_before'] = _measure(lambda: [renderer.get_combo_before(x) for x in beat_lines], repeat)
+    layout, stages['layout'] = _measure(lambda: ChainbeetRenderer(chart)._create_layout(), repeat)
+    image, stages['draw'] = _measure(lambda: renderer._render_region(layout, 0, layout.surface_height), repeat)
+    pages, stages['page_split'] = _measure(lambda: renderer._split_pages(layout, image), repeat)
+    _, stages['encode_png'] = _measure(lambda: pages.encodeToData(sk.EncodedImageFormat.kPNG, 100), repeat)
+    return stages
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(specs: list[ChartSpec], charts: list[str], repeat: int = 3) -> dict[str, Any]:
+    results: list[dict[str, Any]] = []
+    for spec in specs:
+        chart_json = json.dumps(generate_chart(spec))
+        results.append({'name': spec.name, 'params': spec.to_dict(), 'stages': benchmark_chart(chart_json, repeat)})
+    for path in charts:
+        with open(path, 'r', encoding='utf-8') as f:
+            chart_json = f.read()
+        results.append({'name': path, 'params': None, 'stages': benchmark_chart(chart_json, repeat)})
+    return {
+        'meta': {
+            'revision': _git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': repeat,
+            'timestamp': time.time(),
+        },
+        'charts': results,
+    }
+
+
+def compare_results(old: dict[str, Any], new: dict[str, Any]) -> str:
+    lines = ['{:<32} {:<26} {:>12} {:>12} {:>8}'.format('chart', 'stage', 'old (ms)', 'new (ms)', 'ratio')]
+    old_charts = {x['name']: x for x in old['charts']}
+    for chart in new['charts']:
+        if chart['name'] not in old_charts:
+            continue
+        old_stages = old_charts[chart['name']]['stages']
+        for stage, value in chart['stages'].items():
+            if stage not in old_stages:
+                continue
+            before, after = old_stages[stage]['seconds_min'], value['seconds_min']
+            lines.append('{:<32} {:<26} {:>12.3f} {:>12.3f} {:>7.2f}x'.format(
+                chart['name'][-32:], stage, before * 1000, after * 1000, after / before if before else float('nan')))
+    return '\n'.join(lines)
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    arg_parser = argparse.ArgumentParser(description='Benchmark chart parsing and rendering stages.')
+    arg_parser.add_argument('-p', '--preset', action='append', choices=sorted(PRESETS),
+                            help='synthetic chart preset, may be repeated (default: all)')
+    arg_parser.add_argument('-c', '--chart', action='append', default=[], help='real chart JSON file to include')
+    arg_parser.add_argument('-r', '--repeat', type=int, default=3, help='timed runs per stage')
+    arg_parser.add_argument('-s', '--seed', type=int, default=None, help='override the seed of every preset')
+    arg_parser.add_argument('-o', '--output', default=None, help='write results as JSON to this path')
+    arg_parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files and exit')
+    args = arg_parser.parse_args(argv)
+    if args.compare:
+        with open(args.compare[0], 'r', encoding='utf-8') as f:
+            old = json.load(f)
+        with open(args.compare[1], 'r', encoding='utf-8') as f:
+            new = json.load(f)
+        print(compare_results(old, new))
+        return 0
+    specs = [ChartSpec(**PRESETS[x].to_dict()) for x in (args.preset or sorted(PRESETS))]
+    if args.seed is not None:
+        for spec in specs:
+            spec.seed = args.seed
+    results = run_benchmarks(specs, args.chart, args.repeat)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+    for chart in results['charts']:
+        print(chart['name'], ', '.join('{} {:.1f}ms'.format(k, v['seconds_min'] * 1000) for k, v in chart['stages'].items()),
+              file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
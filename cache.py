@@ -0,0 +1,168 @@
+from parser import NoteInfo, parse
+from renderer import ChainbeetRenderer, ChainbeetRenderConfig, RENDERER_VERSION
+from typing import Optional
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import threading
+
+
+def render_key(
+    chart_json: str | bytes,
+    mirror: bool = False,
+    config: Optional[ChainbeetRenderConfig] = None,
+    chart_name: Optional[str] = None
+) -> str:
+    config = config or ChainbeetRenderConfig()
+    if isinstance(chart_json, str):
+        chart_json = chart_json.encode('utf-8')
+    params = {
+        'mirror': mirror,
+        'config': {x: getattr(config, x) for x in ChainbeetRenderConfig.__annotations__},
+        'chart_name': chart_name,
+        'version': RENDERER_VERSION,
+    }
+    digest = hashlib.sha256(chart_json)
+    digest.update(b'\0')
+    digest.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class CachedRender:
+    key: str
+    image: bytes
+    chart: Optional[NoteInfo]
+
+    def __init__(self, key: str, image: bytes, chart: Optional[NoteInfo]) -> None:
+        self.key = key
+        self.image = image
+        self.chart = chart
+
+
+class RenderCache:
+    # On-disk cache of encoded PNG renders and their parsed charts, evicted least-recently-used once it grows
+    # beyond max_bytes. Recency is kept in file modification times so it survives restarts.
+    directory: str
+    max_bytes: int
+    hits: int
+    misses: int
+    evictions: int
+
+    def __init__(self, directory: str, max_bytes: int = 1 << 30) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries: dict[str, int] = {}
+        self._size = 0
+        os.makedirs(directory, exist_ok=True)
+        found: list[tuple[float, str, int]] = []
+        for file in os.listdir(directory):
+            if file.endswith('.png'):
+                key = file[:-4]
+                stat = os.stat(os.path.join(directory, file))
+                found.append((stat.st_mtime, key, stat.st_size + self._chart_size(key)))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._size += size
+
+    def _image_path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.png')
+
+    def _chart_path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.chart')
+
+    def _chart_size(self, key: str) -> int:
+        try:
+            return os.path.getsize(self._chart_path(key))
+        except OSError:
+            return 0
+
+    def _write(self, path: str, data: bytes):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def _remove(self, key: str):
+        self._size -= self._entries.pop(key)
+        for path in (self._image_path(key), self._chart_path(key)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def get(self, key: str, load_chart: bool = True) -> Optional[CachedRender]:
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            try:
+                with open(self._image_path(key), 'rb') as f:
+                    image = f.read()
+                os.utime(self._image_path(key))
+            except OSError:
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries[key] = self._entries.pop(key)
+            self.hits += 1
+        chart = None
+        if load_chart:
+            try:
+                with open(self._chart_path(key), 'rb') as f:
+                    chart = pickle.load(f)
+            except Exception:
+                # A missing, truncated or otherwise corrupt chart file only loses the chart, the image is still valid
+                chart = None
+        return CachedRender(key, image, chart)
+
+    def put(self, key: str, image: bytes, chart: Optional[NoteInfo] = None):
+        chart_data = pickle.dumps(chart, pickle.HIGHEST_PROTOCOL) if chart is not None else None
+        size = len(image) + (len(chart_data) if chart_data else 0)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if chart_data:
+                self._write(self._chart_path(key), chart_data)
+            self._write(self._image_path(key), image)
+            self._entries[key] = size
+            self._size += size
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def render(
+        self,
+        chart_json: str | bytes,
+        mirror: bool = False,
+        config: Optional[ChainbeetRenderConfig] = None,
+        chart_name: Optional[str] = None
+    ) -> CachedRender:
+        key = render_key(chart_json, mirror, config, chart_name)
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        import skia as sk
+        chart = parse(chart_json, mirror)
+        image = ChainbeetRenderer(chart, config, chart_name).render()
+        data = bytes(image.encodeToData(sk.EncodedImageFormat.kPNG, 100))
+        self.put(key, data, chart)
+        return CachedRender(key, data, chart)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'bytes': self._size,
+        }
@@ -0,0 +1,234 @@
+from parser import ChartColumns, NoteInfo, fill_columns, parse_columns
+from typing import BinaryIO, Optional, TextIO
+import argparse
+import mmap
+import os
+import sys
+import numpy as np
+
+# Binary chart layout, all little-endian:
+#   header        _HEADER
+#   records       one _record_dtype(flags) per note, in parse order
+#   arguments     _ARGUMENT * arg_count, for the notes that have type arguments
+#   string table  uint32 * (string_count + 1) end offsets followed by the UTF-8 bytes
+# Records hold the six raw fields and the charge / chain link of each note. Everything else, positions, times,
+# BPMs and the argument columns, is derived from them when loading exactly as parser.parse_columns does.
+MAGIC = b'CBTC'
+VERSION = 2
+EXTENSION = '.cbc'
+
+# Raw fields are stored as int16 unless a chart needs more
+FLAG_WIDE_RAW = 1
+
+_HEADER = np.dtype([
+    ('magic', 'S4'),
+    ('version', '<u2'),
+    ('flags', '<u2'),
+    ('count', '<u4'),
+    ('string_count', '<u4'),
+    ('bpm', '<f8'),
+    ('delay', '<i8'),
+    ('directory', '<i4'),
+    ('arg_count', '<u4'),
+])
+
+_ARGUMENT = np.dtype([
+    ('index', '<u4'),
+    ('count', 'u1'),
+    ('kind', 'u1', (2,)),
+    ('value', '<i8', (2,)),
+])
+
+# Kinds of the type arguments following the six raw fields. Floats are stored by their bits, strings as string
+# table indices.
+_ARG_INT = 1
+_ARG_FLOAT = 2
+_ARG_STR = 3
+_ARG_BOOL = 4
+_ARG_NULL = 5
+
+
+def _record_dtype(flags: int) -> np.dtype:
+    return np.dtype([
+        ('raw', '<i4' if flags & FLAG_WIDE_RAW else '<i2', (6,)),
+        ('next_index', '<i4'),
+    ])
+
+
+class ChartFileError(ValueError):
+    pass
+
+
+def _encode_args(args: tuple, strings: dict[str, int]) -> tuple[list[int], list[int]]:
+    kinds, values = [0, 0], [0, 0]
+    for k, arg in enumerate(args):
+        if isinstance(arg, bool):
+            kinds[k], values[k] = _ARG_BOOL, int(arg)
+        elif isinstance(arg, int):
+            kinds[k], values[k] = _ARG_INT, arg
+        elif isinstance(arg, float):
+            kinds[k], values[k] = _ARG_FLOAT, int(np.float64(arg).view(np.int64))
+        elif isinstance(arg, str):
+            kinds[k], values[k] = _ARG_STR, strings.setdefault(arg, len(strings))
+        elif arg is None:
+            kinds[k] = _ARG_NULL
+        else:
+            raise ChartFileError('unsupported note argument: {!r}'.format(arg))
+    return kinds, values
+
+
+def _decode_arg(kind: int, value: int, float_value: float, strings: list[str]):
+    match kind:
+        case 1:
+            return value
+        case 2:
+            return float_value
+        case 3:
+            return strings[value]
+        case 4:
+            return bool(value)
+        case 5:
+            return None
+    raise ChartFileError('unknown note argument kind: {}'.format(kind))
+
+
+def dumps(chart: ChartColumns) -> bytes:
+    # Positions are not stored, so a mirrored chart is written the same as its unmirrored source
+    count = len(chart)
+    strings: dict[str, int] = {}
+    header = np.zeros(1, dtype=_HEADER)
+    header['magic'] = MAGIC
+    header['version'] = VERSION
+    header['count'] = count
+    header['bpm'] = chart.bpm
+    header['delay'] = chart.delay
+    header['directory'] = -1 if chart.directory is None else strings.setdefault(chart.directory, len(strings))
+    int16 = np.iinfo(np.int16)
+    flags = 0 if not count or (chart.raw.min() >= int16.min and chart.raw.max() <= int16.max) else FLAG_WIDE_RAW
+    header['flags'] = flags
+    records = np.zeros(count, dtype=_record_dtype(flags))
+    records['raw'] = chart.raw
+    records['next_index'] = chart.next_index
+    arguments = np.zeros(len(chart.type_args), dtype=_ARGUMENT)
+    for k, (i, args) in enumerate(sorted(chart.type_args.items())):
+        if len(args) > 2:
+            raise ChartFileError('note {} has more than two arguments'.format(i))
+        kinds, values = _encode_args(args, strings)
+        arguments[k] = (i, len(args), kinds, values)
+    header['arg_count'] = len(arguments)
+    header['string_count'] = len(strings)
+    encoded = [x.encode('utf-8') for x in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype='<u4')
+    offsets[1:] = np.cumsum([len(x) for x in encoded])
+    return header.tobytes() + records.tobytes() + arguments.tobytes() + offsets.tobytes() + b''.join(encoded)
+
+
+def write(chart: ChartColumns, dest: str | BinaryIO):
+    data = dumps(chart)
+    if isinstance(dest, (str, os.PathLike)):
+        with open(dest, 'wb') as f:
+            f.write(data)
+    else:
+        dest.write(data)
+
+
+def loads(data, mirror: bool = False) -> ChartColumns:
+    # data is any buffer, records are read from it without an intermediate copy
+    if len(data) < _HEADER.itemsize:
+        raise ChartFileError('truncated chart file')
+    header = np.frombuffer(data, dtype=_HEADER, count=1)[0]
+    if header['magic'] != MAGIC:
+        raise ChartFileError('not a binary chart file')
+    if header['version'] != VERSION:
+        raise ChartFileError('unsupported binary chart version: {}'.format(header['version']))
+    record = _record_dtype(int(header['flags']))
+    count = int(header['count'])
+    arg_count = int(header['arg_count'])
+    string_count = int(header['string_count'])
+    records_end = _HEADER.itemsize + record.itemsize * count
+    arguments_end = records_end + _ARGUMENT.itemsize * arg_count
+    offsets_end = arguments_end + 4 * (string_count + 1)
+    if len(data) < offsets_end:
+        raise ChartFileError('truncated chart file')
+    records = np.frombuffer(data, dtype=record, count=count, offset=_HEADER.itemsize)
+    arguments = np.frombuffer(data, dtype=_ARGUMENT, count=arg_count, offset=records_end)
+    offsets = np.frombuffer(data, dtype='<u4', count=string_count + 1, offset=arguments_end).tolist()
+    if len(data) < offsets_end + offsets[-1]:
+        raise ChartFileError('truncated chart file')
+    blob = bytes(data[offsets_end:offsets_end + offsets[-1]])
+    strings = [blob[offsets[k]:offsets[k + 1]].decode('utf-8') for k in range(string_count)]
+    directory = int(header['directory'])
+    chart = ChartColumns(float(header['bpm']), None if directory < 0 else strings[directory], int(header['delay']),
+                         mirror)
+    chart.raw = records['raw'].astype(np.int32)
+    chart.type_args = {}
+    values = arguments['value']
+    float_values = values.view('<f8').tolist()
+    values = values.tolist()
+    kinds = arguments['kind'].tolist()
+    for k, (i, n) in enumerate(zip(arguments['index'].tolist(), arguments['count'].tolist())):
+        chart.type_args[i] = tuple(_decode_arg(kinds[k][j], values[k][j], float_values[k][j], strings)
+                                   for j in range(n))
+    fill_columns(chart, records['next_index'])
+    return chart
+
+
+def _read(source: str | BinaryIO | TextIO):
+    # Paths are memory-mapped, file objects are read whole
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b''
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return source.read()
+
+
+def load_columns(source: str | BinaryIO | TextIO, mirror: bool = False) -> ChartColumns:
+    # Loads a binary chart, or falls back to parsing chart JSON
+    data = _read(source)
+    if isinstance(data, str):
+        return parse_columns(data, mirror)
+    if data[:len(MAGIC)] == MAGIC:
+        return loads(data, mirror)
+    return parse_columns(bytes(data), mirror)
+
+
+def load(source: str | BinaryIO | TextIO, mirror: bool = False) -> NoteInfo:
+    # Gives the same NoteInfo as parser.parse for the same chart
+    return load_columns(source, mirror).note_info()
+
+
+def convert(source: str | BinaryIO | TextIO, dest: str | BinaryIO):
+    write(load_columns(source), dest)
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    arg_parser = argparse.ArgumentParser(description='Convert ChainBeeT chart JSON to the binary chart format.')
+    arg_parser.add_argument('source', help='chart JSON file, or a directory searched recursively for them')
+    arg_parser.add_argument('-o', '--output', default=None,
+                            help='output directory (default: next to each source file)')
+    args = arg_parser.parse_args(argv)
+    if os.path.isdir(args.source):
+        paths = sorted(os.path.join(root, x) for root, _, files in os.walk(args.source)
+                       for x in files if x.endswith('.json'))
+        base = args.source
+    else:
+        paths = [args.source]
+        base = os.path.dirname(args.source)
+    failed = 0
+    for path in paths:
+        output = os.path.splitext(path)[0] + EXTENSION
+        if args.output:
+            output = os.path.join(args.output, os.path.relpath(output, base))
+            os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+        try:
+            convert(path, output)
+        except Exception as e:
+            print('FAILED {}: {}: {}'.format(path, type(e).__name__, e), file=sys.stderr)
+            failed += 1
+    print('{} charts converted, {} failed'.format(len(paths) - failed, failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
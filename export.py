@@ -0,0 +1,138 @@
+from concurrent.futures import ThreadPoolExecutor
+from parser import parse
+from renderer import ChainbeetRenderer
+from typing import Any, Optional
+import argparse
+import json
+import os
+import sys
+import skia as sk
+
+FORMATS = {
+    'png': sk.EncodedImageFormat.kPNG,
+    'webp': sk.EncodedImageFormat.kWEBP,
+    'jpeg': sk.EncodedImageFormat.kJPEG,
+}
+EXTENSIONS = {'png': '.png', 'webp': '.webp', 'jpeg': '.jpg'}
+_DEFAULT_QUALITY = {'png': 100, 'webp': 80, 'jpeg': 90}
+
+
+class EncodeOptions:
+    # quality is 0-100 for JPEG and WebP, WebP at 100 is lossless. PNG is always lossless and ignores it.
+    format: str
+    quality: int
+
+    def __init__(self, format: str = 'png', quality: Optional[int] = None) -> None:
+        if format not in FORMATS:
+            raise ValueError('unknown image format: {}'.format(format))
+        if quality is not None and not 0 <= quality <= 100:
+            raise ValueError('quality must be between 0 and 100: {}'.format(quality))
+        self.format = format
+        self.quality = _DEFAULT_QUALITY[format] if quality is None else quality
+
+    @property
+    def extension(self) -> str:
+        return EXTENSIONS[self.format]
+
+
+def encode_image(image: sk.Image, options: Optional[EncodeOptions] = None) -> bytes:
+    options = options or EncodeOptions()
+    data = image.encodeToData(FORMATS[options.format], options.quality)
+    if data is None:
+        raise RuntimeError('failed to encode image as {}'.format(options.format))
+    return bytes(data)
+
+
+class ExportedPage:
+    index: int
+    path: str
+    start_time: float
+    end_time: float
+    width: int
+    height: int
+    size: int
+
+    def __init__(self, index: int, path: str, start_time: float, end_time: float, width: int, height: int,
+                 size: int) -> None:
+        self.index = index
+        self.path = path
+        self.start_time = start_time
+        self.end_time = end_time
+        self.width = width
+        self.height = height
+        self.size = size
+
+    def to_dict(self, base: str) -> dict[str, Any]:
+        return {
+            'index': self.index,
+            'file': os.path.relpath(self.path, base),
+            'start_time': self.start_time,
+            'end_time': self.end_time,
+            'width': self.width,
+            'height': self.height,
+            'bytes': self.size,
+        }
+
+
+def export_pages(
+    renderer: ChainbeetRenderer,
+    output_dir: str,
+    options: Optional[EncodeOptions] = None,
+    name: str = 'page',
+    workers: Optional[int] = None,
+    tiled: bool = False,
+    manifest: Optional[str] = 'manifest.json'
+) -> list[ExportedPage]:
+    # Writes every page as its own image, encoded in parallel on a thread pool, plus a JSON manifest listing the
+    # files with the time range each page covers. With tiled=True pages are drawn one by one and each is handed
+    # to the encoders as soon as it is ready.
+    options = options or EncodeOptions()
+    os.makedirs(output_dir, exist_ok=True)
+
+    def encode(index: int, image: sk.Image) -> ExportedPage:
+        data = encode_image(image, options)
+        path = os.path.join(output_dir, '{}-{:03d}{}'.format(name, index, options.extension))
+        with open(path, 'wb') as f:
+            f.write(data)
+        start_time, end_time = renderer.page_time_range(index)
+        return ExportedPage(index, path, start_time, end_time, image.width(), image.height(), len(data))
+
+    images = renderer.render_pages() if tiled else renderer.render_page_images()
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+        futures = [executor.submit(encode, i, image) for i, image in enumerate(images)]
+        pages = [x.result() for x in futures]
+    if manifest:
+        chart = renderer.chart
+        with open(os.path.join(output_dir, manifest), 'w', encoding='utf-8') as f:
+            json.dump({
+                'chart_name': renderer.chart_name,
+                'bpm': chart.bpm,
+                'mirror': chart.is_mirror,
+                'format': options.format,
+                'quality': options.quality,
+                'pages': [x.to_dict(output_dir) for x in pages],
+            }, f, indent=2)
+    return pages
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    arg_parser = argparse.ArgumentParser(description='Render a ChainBeeT chart to one image per page.')
+    arg_parser.add_argument('chart', help='chart JSON file')
+    arg_parser.add_argument('-o', '--output', default='output', help='output directory')
+    arg_parser.add_argument('-f', '--format', default='png', choices=sorted(FORMATS), help='image format')
+    arg_parser.add_argument('-q', '--quality', type=int, default=None, help='JPEG / WebP quality, 0-100')
+    arg_parser.add_argument('-n', '--name', default=None, help='chart name shown on the pages')
+    arg_parser.add_argument('-m', '--mirror', action='store_true', help='render the mirrored chart')
+    arg_parser.add_argument('-j', '--workers', type=int, default=None, help='encoder threads (default: CPU count)')
+    arg_parser.add_argument('--tiled', action='store_true', help='draw page by page to bound memory use')
+    args = arg_parser.parse_args(argv)
+    with open(args.chart, 'r', encoding='utf-8') as f:
+        chart = parse(f.read(), args.mirror)
+    pages = export_pages(ChainbeetRenderer(chart, chart_name=args.name), args.output,
+                         EncodeOptions(args.format, args.quality), workers=args.workers, tiled=args.tiled)
+    print('{} pages written to {}'.format(len(pages), args.output))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,6 @@
 import json
-from typing import NamedTuple
+import numpy as np
+from typing import NamedTuple, Optional
 
 
 class NoteRawInfo(NamedTuple):
@@ -25,6 +26,9 @@ class Note:
     prev_note: "Note | None"
     next_note: "Note | None"
     raw_info: NoteRawInfo
+
+    __slots__ = ('note_type', 'position', 'time', 'bpm', 'file', 'group', 'change_bpm', 'width', 'time_scale',
+                 'prev_note', 'next_note', 'raw_info')
     
     def __init__(self, note_type: int, position: float, time: float, bpm: float, type_arg, type_arg_2, raw_info: NoteRawInfo) -> None:
         self.note_type = note_type
@@ -91,6 +95,35 @@ class NoteInfo:
         self.notes = notes
         self.is_mirror = is_mirror
 
+    def __getstate__(self) -> dict:
+        # Notes are pickled flat with their links as list indices, following the links recursively overflows the
+        # stack on long charge and chain groups
+        index = {id(x): i for i, x in enumerate(self.notes)}
+        state = self.__dict__.copy()
+        state['notes'] = (
+            [tuple(getattr(x, name) for name in _NOTE_FIELDS) for x in self.notes],
+            [-1 if x.prev_note is None else index[id(x.prev_note)] for x in self.notes],
+            [-1 if x.next_note is None else index[id(x.next_note)] for x in self.notes],
+        )
+        return state
+
+    def __setstate__(self, state: dict):
+        fields, prev_index, next_index = state['notes']
+        notes: list[Note] = []
+        for values in fields:
+            note = Note.__new__(Note)
+            for name, value in zip(_NOTE_FIELDS, values):
+                setattr(note, name, value)
+            notes.append(note)
+        for note, i, j in zip(notes, prev_index, next_index):
+            note.prev_note = None if i < 0 else notes[i]
+            note.next_note = None if j < 0 else notes[j]
+        self.__dict__.update(state)
+        self.notes = notes
+
+
+_NOTE_FIELDS = tuple(x for x in Note.__slots__ if x not in ('prev_note', 'next_note'))
+
 
 def _raw_note_sort_key(note) -> float:
     beat_plus: int = note[0]
@@ -100,7 +133,11 @@ def _raw_note_sort_key(note) -> float:
 
     
 def parse(info_json: str, mirror: bool=False) -> NoteInfo:
-    value = json.loads(info_json)
+    return parse_value(json.loads(info_json), mirror)
+
+
+def parse_value(value: dict, mirror: bool=False) -> NoteInfo:
+    # Same as parse, for a chart that is already decoded. The notes list of value is sorted in place.
     info_value = value['info']
     info = NoteInfo(float(info_value['bpm']), info_value.get('dir'), int(info_value.get('delay', 0)), [], mirror)
     notes = value['notes']
@@ -151,3 +188,166 @@ def parse(info_json: str, mirror: bool=False) -> NoteInfo:
                 logic_note.prev_note = prev
                 chain_group_end[logic_note.group] = logic_note
     return info
+
+
+class ChartColumns:
+    # Structure-of-arrays form of a parsed chart, one entry per note in parse order. Absent values are -1 for
+    # integer columns and NaN for float columns. Note objects are only built on demand by note_info().
+    bpm: float
+    directory: str | None
+    delay: int
+    is_mirror: bool
+    time: np.ndarray
+    position: np.ndarray
+    note_bpm: np.ndarray
+    note_type: np.ndarray
+    group: np.ndarray
+    width: np.ndarray
+    time_scale: np.ndarray
+    change_bpm: np.ndarray
+    prev_index: np.ndarray
+    next_index: np.ndarray
+    raw: np.ndarray
+    type_args: dict[int, tuple]
+
+    def __init__(self, bpm: float, directory: str | None, delay: int, is_mirror: bool = False) -> None:
+        self.bpm = bpm
+        self.directory = directory
+        self.delay = delay
+        self.is_mirror = is_mirror
+        self._note_info: Optional[NoteInfo] = None
+
+    def __len__(self) -> int:
+        return len(self.time)
+
+    def meta_mask(self) -> np.ndarray:
+        return self.note_type < 10
+
+    def note_info(self) -> NoteInfo:
+        if self._note_info is None:
+            notes: list[Note] = []
+            # Whole columns are converted to Python values up front, indexing arrays per note is much slower
+            position, time, note_bpm = self.position.tolist(), self.time.tolist(), self.note_bpm.tolist()
+            type_args = self.type_args
+            new_note = Note.__new__
+            for i, raw in enumerate(self.raw.tolist()):
+                if raw[5] == 10 and i not in type_args:
+                    # Plain tap notes are most of a chart, their attributes are set without going through __init__
+                    note = new_note(Note)
+                    note.note_type, note.position, note.time, note.bpm = 10, position[i], time[i], note_bpm[i]
+                    note.file = note.group = note.change_bpm = note.width = note.time_scale = None
+                    note.prev_note = note.next_note = None
+                    note.raw_info = NoteRawInfo(raw[0], raw[1], raw[2], raw[3], raw[4], raw[5], raw)
+                    notes.append(note)
+                    continue
+                type_arg, type_arg_2 = None, None
+                if i in type_args:
+                    raw += type_args[i]
+                    type_arg = raw[6]
+                    type_arg_2 = raw[7] if len(raw) >= 8 else None
+                raw_info = NoteRawInfo(raw[0], raw[1], raw[2], raw[3], raw[4], raw[5], raw)
+                notes.append(Note(raw[5], position[i], time[i], note_bpm[i], type_arg, type_arg_2, raw_info))
+            next_index = self.next_index.tolist()
+            for i in np.flatnonzero(self.next_index >= 0).tolist():
+                notes[i].next_note = notes[next_index[i]]
+                notes[next_index[i]].prev_note = notes[i]
+            self._note_info = NoteInfo(self.bpm, self.directory, self.delay, notes, self.is_mirror)
+        return self._note_info
+
+
+def parse_columns(info_json: str, mirror: bool = False) -> ChartColumns:
+    value = json.loads(info_json)
+    info_value = value['info']
+    chart = ChartColumns(float(info_value['bpm']), info_value.get('dir'), int(info_value.get('delay', 0)), mirror)
+    notes = value['notes']
+    count = len(notes)
+    raw = np.array([x[:6] for x in notes], dtype=np.int64).reshape(count, 6)
+    beat_plus, _, beat_split, _, beat_idx, _ = raw.T
+    order = np.argsort((beat_idx / beat_split) + beat_plus, kind='stable')
+    chart.raw = raw[order].astype(np.int32)
+    chart.type_args = {i: tuple(notes[k][6:8]) for i, k in enumerate(order.tolist()) if len(notes[k]) >= 7}
+    fill_columns(chart)
+    return chart
+
+
+def fill_columns(chart: ChartColumns, next_index: Optional[np.ndarray] = None):
+    # Derives every other column from chart.raw, in parse order, and chart.type_args. Charge and chain links are
+    # rebuilt from the groups unless next_index is given.
+    raw = chart.raw
+    count = len(raw)
+    beat_plus, position_split, beat_split, position_idx, beat_idx, note_type = raw.T
+    beat = (beat_idx / beat_split) + beat_plus
+    type_args = chart.type_args
+    chart.note_type = note_type.astype(np.int16)
+    if chart.is_mirror:
+        position_idx = ~position_idx + position_split
+    if (position_split == 1).any():
+        raise ZeroDivisionError('division by zero')
+    chart.position = position_idx / (position_split - 1)
+    # Time segments between BPM changes, a BPM change note itself still uses the previous BPM
+    bpm_change_indices = np.flatnonzero(note_type == 2)
+    segment = np.searchsorted(bpm_change_indices, np.arange(count), side='left')
+    segment_time = [0.0]
+    segment_bpm = [chart.bpm]
+    segment_minus_beat = [0.0]
+    for i in bpm_change_indices.tolist():
+        time_delta = (60.0 / segment_bpm[-1] * 4) * (beat[i] - segment_minus_beat[-1])
+        segment_time.append(segment_time[-1] + time_delta)
+        segment_minus_beat.append(beat_idx[i] / beat_split[i] + beat_plus[i])
+        segment_bpm.append(float(type_args[i][0]))
+    segment_time_array = np.array(segment_time)[segment]
+    segment_bpm_array = np.array(segment_bpm)[segment]
+    segment_minus_beat_array = np.array(segment_minus_beat)[segment]
+    chart.time = segment_time_array + (60.0 / segment_bpm_array * 4) * (beat - segment_minus_beat_array)
+    chart.note_bpm = segment_bpm_array
+    # Type arguments, following the Note constructor
+    chart.group = np.full(count, -1, dtype=np.int32)
+    chart.width = np.full(count, np.nan)
+    chart.time_scale = np.full(count, np.nan)
+    chart.change_bpm = np.full(count, np.nan)
+    for i, args in type_args.items():
+        arg = args[0]
+        t = int(note_type[i])
+        numeric = isinstance(arg, (int, float)) and not isinstance(arg, bool)
+        if t == 2 and numeric:
+            chart.change_bpm[i] = arg
+        elif t == 3 and numeric:
+            chart.time_scale[i] = arg
+        if 20 <= t < 23 or 50 <= t < 52 or 30 <= t < 34:
+            chart.group[i] = int(arg)
+        if t >= 40:
+            width = arg if t == 40 else (args[1] if len(args) >= 2 else None)
+            chart.width[i] = np.nan if width is None else width
+    # Charge and chain links
+    chart.prev_index = np.full(count, -1, dtype=np.int32)
+    if next_index is not None:
+        chart.next_index = next_index.astype(np.int32)
+        linked = np.flatnonzero(chart.next_index >= 0)
+        chart.prev_index[chart.next_index[linked]] = linked
+        return
+    chart.next_index = np.full(count, -1, dtype=np.int32)
+    charge_group_end: dict[int, int] = {}
+    chain_group_end: dict[int, int] = {}
+    linked = np.flatnonzero(((note_type >= 20) & (note_type < 23)) | ((note_type >= 50) & (note_type < 52))
+                            | ((note_type >= 30) & (note_type < 33)))
+    for i in linked.tolist():
+        group = int(chart.group[i])
+        match int(note_type[i]):
+            case 20 | 50:
+                charge_group_end[group] = i
+            case 21 | 51:
+                prev = charge_group_end.pop(group)
+                chart.next_index[prev] = i
+                chart.prev_index[i] = prev
+            case 22:
+                prev = charge_group_end[group]
+                chart.next_index[prev] = i
+                chart.prev_index[i] = prev
+                charge_group_end[group] = i
+            case 30:
+                chain_group_end[group] = i
+            case 31 | 32:
+                prev = chain_group_end[group]
+                chart.next_index[prev] = i
+                chart.prev_index[i] = prev
+                chain_group_end[group] = i
@@ -1,78 +1,29 @@
-from parser import NoteInfo, Note
-from typing import Optional
+from __future__ import annotations
+from analysis import ComboIndex, analyze_beat_lines, analyze_beats, analyze_coincident_lines
+from contextlib import contextmanager
+from parser import NoteInfo, Note, parse_value
+from typing import TYPE_CHECKING, Callable, Iterator, Optional
+import bisect
+import hashlib
 import math
-import skia as sk
-
-
-def analyze_beat_lines(chart: NoteInfo, max_time: Optional[float] = None) -> list[float]:
-    bpm_changes = [x for x in chart.notes if x.note_type == 2]
-    max_time = max(x.time for x in chart.notes) if max_time is None else max_time
-    curr_bpm = chart.bpm
-    curr_time = 0.0
-    timings: list[float] = []
-    curr_index = 0
-    while True:
-        limit_time = max_time if curr_index >= len(bpm_changes) else bpm_changes[curr_index].time
-        delta_time = 60 / curr_bpm * 4
-        while curr_time + delta_time < limit_time:
-            curr_time += delta_time
-            timings.append(curr_time)
-        if curr_index < len(bpm_changes):
-            curr_bpm = bpm_changes[curr_index].change_bpm
-            timings.append(bpm_changes[curr_index].time)
-            curr_time = bpm_changes[curr_index].time
-        else:
-            break
-        curr_index += 1
-    return timings
-
-
-def analyze_coincident_lines(notes: list[Note]) -> list[tuple[float, list[Note]]]:
-    timings: dict[float, list[Note]] = {}
-    for note in notes:
-        if note.is_meta_note():
-            continue
-        if note.time not in timings:
-            timings[note.time] = []
-        timings[note.time].append(note)
-    result: list[tuple[float, list[Note]]] = []
-    for time, note_list in timings.items():
-        if len(note_list) < 2:
-            continue
-        note_list.sort(key=lambda x: x.position)
-        result.append((time, note_list))
-    return result
-
-
-def analyze_beats(notes: list) -> list[tuple[float, int]]:
-    timings: list[float] = []
-    timing_bpm: dict[float, float] = {}
-    for note in notes:
-        if note.is_meta_note():
-            continue
-        timings.append(note.time)
-        timing_bpm[note.time] = note.bpm
-    timings = sorted(list(set(timings)))
-    result: list[tuple[float, int]] = []
-    error_tolerance: float = 0.05
-    for i in range(len(timings)):
-        curr = timings[i]
-        time_delta = 60.0 / timing_bpm[curr] * 4
-        beat = 0
-        # if i > 0:
-        #     prev = time_delta / (curr - timings[i - 1])
-        #     if abs(prev - round(prev)) < error_tolerance:
-        #         beat = max(beat, round(prev))
-        if i < len(timings) - 1:
-            nxt = time_delta / (timings[i + 1] - curr)
-            if abs(nxt - round(nxt)) < error_tolerance:
-                beat = max(beat, round(nxt))
-        if beat % 2 == 0 and beat:
-            result.append((curr, beat))
-    return result
+import time as _time
+import numpy as np
+
+# Skia is imported where something is drawn, so importing the renderer for its config, RENDERER_VERSION or the
+# analysis functions does not load the native library
+if TYPE_CHECKING:
+    import skia as sk
+
+def _raw_id(note: Optional[Note]) -> Optional[int]:
+    return None if note is None else id(note.raw_info.raw_params)
+
+
+# Bump whenever a change alters rendered output, so caches keyed on it are invalidated
+RENDERER_VERSION = 1
 
 
 def _create_charge_path(width: float, base_size: float):
+    import skia as sk
     extra_width = width - base_size * 2
     half_width = extra_width / 2
     path = sk.Path()
@@ -89,6 +40,7 @@ def _create_charge_path(width: float, base_size: float):
 
 
 def _create_chain_path(base_size: float):
+    import skia as sk
     path = sk.Path()
     path.moveTo(0, -base_size)
     path.lineTo(base_size, 0)
@@ -98,6 +50,42 @@ def _create_chain_path(base_size: float):
     return path
 
 
+class _NoteGeometry:
+    # Note shapes and short labels shared by every draw pass of one renderer. Paths are built around the origin
+    # once and only ever copied out, so they are never mutated while drawing.
+    chain_path: sk.Path
+    charge_paths: dict[float, sk.Path]
+    text_blobs: dict[tuple[int, str], sk.TextBlob]
+    paths_created: int
+
+    def __init__(self, base_size: float) -> None:
+        self.base_size = base_size
+        self.chain_path = _create_chain_path(base_size)
+        self.charge_paths = {}
+        self.text_blobs = {}
+        self.paths_created = 1
+
+    def charge_path(self, width: float) -> sk.Path:
+        path = self.charge_paths.get(width)
+        if path is None:
+            path = self.charge_paths[width] = _create_charge_path(width, self.base_size)
+            self.paths_created += 1
+        return path
+
+    def text_blob(self, text: str, font: sk.Font) -> sk.TextBlob:
+        import skia as sk
+        key = (id(font), text)
+        blob = self.text_blobs.get(key)
+        if blob is None:
+            blob = self.text_blobs[key] = sk.TextBlob.MakeFromString(text, font)
+        return blob
+
+
+_BACKGROUND_COLOR = 0xff080403
+_CULL_MARGIN = 50
+_STRIP_PADDING = 64
+
+
 def _get_time_description(time: float) -> str:
     seconds = time % 60
     minutes = int(time // 60)
@@ -119,117 +107,316 @@ class ChainbeetRenderConfig:
     max_time_scale: float = 2.0
 
 
+class ChainbeetPaints:
+    # Paints and fonts used by ChainbeetRenderer. They are never modified while drawing, so one instance can be
+    # shared by every renderer in a process instead of being rebuilt for each chart.
+    def __init__(self) -> None:
+        import skia as sk
+        self.tap_paint = sk.Paint(Color=0xff7b013d, AntiAlias=True)
+        self.note_stroke_paint = sk.Paint(Color=0xffe8c9c7, AntiAlias=True, Style=sk.Paint.kStroke_Style, StrokeWidth=2.5)
+        self.note_bold_stroke_paint = sk.Paint(Color=0xffe8c9c7, AntiAlias=True, Style=sk.Paint.kStroke_Style, StrokeWidth=4)
+        self.chain_paint = sk.Paint(Color=0xff004a80)
+        self.charge_paint = sk.Paint(Color=0xff3c7b1e)
+        self.charge_segment_paint = sk.Paint(Color=0xff374219, AntiAlias=True)
+        self.charge_segment_stroke_paint = sk.Paint(Color=0xdde8c9c7, AntiAlias=True, Style=sk.Paint.kStroke_Style,
+                                                    StrokeWidth=1)
+        self.chain_connection_paint = sk.Paint(Color=0xffeeeeee, AntiAlias=True,
+                                               PathEffect=sk.DashPathEffect.Make([15, 15], 0))
+        self.line_paint = sk.Paint(Color=0xffeeeeee)
+        self.beat_line_paint = sk.Paint(Color=0xff888888, StrokeWidth=1)
+        self.layer_paint = sk.Paint(Color=0x11ffff00)
+        self.boundary_paint = sk.Paint(Color=0xffffffff)
+        self.text_paint = sk.Paint(Color=0xffffffff)
+        self.hint_font = sk.Font()
+        self.hint_font.setSize(20)
+        self.beat_font = sk.Font()
+        self.beat_font.setSize(20)
+        self.change_font = sk.Font()
+        self.change_font.setSize(16)
+        self.info_font = sk.Font()
+        self.info_font.setSize(40)
+        # Font metrics do not change after setSize, look them up once instead of for every label
+        self.hint_descent = self.hint_font.getMetrics().fDescent
+        self.hint_spacing = self.hint_font.getSpacing()
+        self.beat_descent = self.beat_font.getMetrics().fDescent
+        self.change_descent = self.change_font.getMetrics().fDescent
+
+
+class RenderStats:
+    # Wall time per render stage and counts of Skia calls made, filled by ChainbeetRenderer.render().
+    # Stages accumulate, so tiled renders add up over all pages.
+    seconds: dict[str, float]
+    counts: dict[str, int]
+
+    def __init__(self) -> None:
+        self.seconds = {}
+        self.counts = {}
+        self._last = _time.perf_counter()
+
+    def restart(self):
+        self._last = _time.perf_counter()
+
+    def lap(self, stage: str):
+        now = _time.perf_counter()
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + now - self._last
+        self._last = now
+
+    def add(self, name: str, count: int):
+        self.counts[name] = self.counts.get(name, 0) + count
+
+    @contextmanager
+    def measure(self, stage: str):
+        # For stages outside the renderer, such as encoding the result
+        self.restart()
+        yield
+        self.lap(stage)
+
+    @property
+    def total_seconds(self) -> float:
+        return sum(self.seconds.values())
+
+    def to_dict(self) -> dict[str, dict]:
+        return {'seconds': dict(self.seconds), 'counts': dict(self.counts)}
+
+
 class ChainbeetRenderer:
     def __init__(
         self,
         chart: NoteInfo,
         config: Optional[ChainbeetRenderConfig] = None,
         chart_name: Optional[str] = None,
-        text_font: Optional[sk.Font] = None
+        text_font: Optional[sk.Font] = None,
+        paints: Optional["ChainbeetPaints"] = None,
+        on_stats: Optional[Callable[["RenderStats"], None]] = None
     ):
         self.config = config or ChainbeetRenderConfig()
+        self.chart_name = chart_name
+        self.text_font = text_font
+        self.paints = paints or ChainbeetPaints()
+        self.on_stats = on_stats
+        self._geometry = _NoteGeometry(self.config.note_base_size)
+        self._pages: dict[int, sk.Image] = {}
+        self._page_digests: dict[int, bytes] = {}
+        self._dirty_from = -math.inf
+        self._load_chart(chart)
+
+    def _load_chart(self, chart: NoteInfo):
         self.chart = chart
         self.bpm = chart.bpm
         self.notes: list[Note] = chart.notes.copy()
         self.notes.sort(key=lambda x: x.time)
         self.speed_changes = [x for x in self.notes if x.note_type == 3]
-        self.chart_name = chart_name
-        self.text_font = text_font
+        self.combo_index = ComboIndex(self.notes)
+        self._layout: Optional[_ChartLayout] = None
+        self._picture: Optional[sk.Picture] = None
+        self._build_time_y_index()
 
-    def compute_time_y(self, time: float) -> float:
+    def _build_time_y_index(self):
+        # Segment k starts at _segment_times[k] with accumulated Y _segment_sums[k] (in time units)
+        # and runs at _segment_speeds[k]. Segment 0 is the implicit 1.0x segment before any change.
+        self._change_times: list[float] = [x.time for x in self.speed_changes]
+        self._segment_times: list[float] = [0.0]
+        self._segment_sums: list[float] = [0.0]
+        self._segment_speeds: list[float] = [1.0]
         current_sum = 0.0
         last_change_time = 0.0
         current_speed = 1.0
-        for i in range(len(self.speed_changes)):
-            if time > self.speed_changes[i].time:
-                current_sum += current_speed * (self.speed_changes[i].time - last_change_time)
-                last_change_time = self.speed_changes[i].time
-                current_speed = min(max(self.config.min_time_scale, self.speed_changes[i].time_scale), self.config.max_time_scale)
-            else:
-                break
+        for change in self.speed_changes:
+            current_sum += current_speed * (change.time - last_change_time)
+            last_change_time = change.time
+            current_speed = min(max(self.config.min_time_scale, change.time_scale), self.config.max_time_scale)
+            self._segment_times.append(last_change_time)
+            self._segment_sums.append(current_sum)
+            self._segment_speeds.append(current_speed)
+        self._segment_times_array = np.array(self._segment_times, dtype=np.float64)
+        self._segment_sums_array = np.array(self._segment_sums, dtype=np.float64)
+        self._segment_speeds_array = np.array(self._segment_speeds, dtype=np.float64)
+
+    def compute_time_y(self, time: float) -> float:
+        k = bisect.bisect_left(self._change_times, time)
+        current_sum = self._segment_sums[k]
+        last_change_time = self._segment_times[k]
         if time > last_change_time:
-            current_sum += current_speed * (time - last_change_time)
+            current_sum += self._segment_speeds[k] * (time - last_change_time)
+        return current_sum * self.config.height_factor
+
+    def compute_time_y_many(self, times) -> np.ndarray:
+        times = np.asarray(times, dtype=np.float64)
+        k = np.searchsorted(self._change_times, times, side='left')
+        last_change_time = self._segment_times_array[k]
+        current_sum = self._segment_sums_array[k]
+        current_sum = np.where(times > last_change_time,
+                               current_sum + self._segment_speeds_array[k] * (times - last_change_time),
+                               current_sum)
         return current_sum * self.config.height_factor
     
+    def compute_y_time(self, y: float) -> float:
+        # Inverse of compute_time_y, extended below time 0 at 1x speed
+        current_sum = y / self.config.height_factor
+        k = max(0, bisect.bisect_right(self._segment_sums, current_sum) - 1)
+        return self._segment_times[k] + (current_sum - self._segment_sums[k]) / self._segment_speeds[k]
+
     def get_combo_before(self, time: float) -> int:
-        return len([x for x in self.notes if x.time < time and not x.is_meta_note()])
+        return self.combo_index.combo_before(time)
 
-    def render(self) -> sk.Image:
+    def _create_layout(self) -> "_ChartLayout":
+        layout = _ChartLayout()
         base_size = self.config.note_base_size
         notes = self.notes
-        max_time = max(x.time for x in notes) + 2
-        height = int(self.compute_time_y(max_time)) + 1
-        width = self.config.track_width
-        surface = sk.Surface(width + self.config.width_extra, height + self.config.height_extra)
-        canvas: sk.Canvas = surface.getCanvas()
-        canvas.translate(self.config.width_extra / 2, self.config.height_extra / 2)
-        tap_paint = sk.Paint(Color=0xff7b013d, AntiAlias=True)
-        note_stroke_paint = sk.Paint(Color=0xffe8c9c7, AntiAlias=True, Style=sk.Paint.kStroke_Style, StrokeWidth=2.5)
-        note_bold_stroke_paint = sk.Paint(Color=0xffe8c9c7, AntiAlias=True, Style=sk.Paint.kStroke_Style, StrokeWidth=4)
-        chain_paint = sk.Paint(Color=0xff004a80)
-        charge_paint = sk.Paint(Color=0xff3c7b1e)
-        charge_segment_paint = sk.Paint(Color=0xff374219, AntiAlias=True)
-        charge_segment_stroke_paint = sk.Paint(Color=0xdde8c9c7, AntiAlias=True, Style=sk.Paint.kStroke_Style,
-                                               StrokeWidth=1)
-        chain_connection_paint = sk.Paint(Color=0xffeeeeee, AntiAlias=True,
-                                          PathEffect=sk.DashPathEffect.Make([15, 15], 0))
-        line_paint = sk.Paint(Color=0xffeeeeee)
-        beat_line_paint = sk.Paint(Color=0xff888888, StrokeWidth=1)
-        chain_path = _create_chain_path(base_size)
-        for note in notes:
-            note.position -= (note.position - 0.5) * (1.0 - self.config.width_scale)
-        layer_paint = sk.Paint(Color=0x11ffff00)
+        layout.margin = _CULL_MARGIN + base_size * 2
+        layout.max_time = max_time = max(x.time for x in notes) + 2
+        layout.height = height = int(self.compute_time_y(max_time)) + 1
+        layout.width = width = self.config.track_width
+        layout.surface_width = width + self.config.width_extra
+        layout.surface_height = height + self.config.height_extra
+        layout.page_count = math.ceil(layout.surface_height / self.config.page_height)
+        layout.info_height = 40
+        layout.image_height = self.config.page_height + self.config.top_margin + self.config.bottom_margin + layout.info_height
+        # Positions squeezed towards the center by width_scale, kept here instead of on the shared notes
+        position_scale = 1.0 - self.config.width_scale
+        scale_position = lambda p: p - (p - 0.5) * position_scale
         # Speed Change Hint
+        layout.speed_rects = []
         for i in range(len(self.speed_changes)):
             if self.speed_changes[i].time_scale != 1:
                 limit_time = max_time if i + 1 >= len(self.speed_changes) else self.speed_changes[i + 1].time
-                canvas.drawRect(sk.Rect(0, height - self.compute_time_y(limit_time), width, height - self.compute_time_y(self.speed_changes[i].time)), layer_paint)
+                layout.speed_rects.append((height - self.compute_time_y(limit_time), height - self.compute_time_y(self.speed_changes[i].time)))
+        layout.speed_rect_index = _SpanIndex(np.array([x[0] for x in layout.speed_rects], dtype=np.float64),
+                                             np.array([x[1] for x in layout.speed_rects], dtype=np.float64))
         # Beatline Hint
-        hint_paint = sk.Paint(Color=0xffffffff)
-        hint_font = sk.Font()
-        hint_font.setSize(20)
-        for time in analyze_beat_lines(self.chart, max_time):
-            y = height - self.compute_time_y(time)
-            combo = str(self.get_combo_before(time))
-            canvas.drawLine(0, y, width, y, beat_line_paint)
-            text_width = hint_font.measureText(combo)
-            canvas.drawString(combo, -text_width - 10, y + hint_font.getMetrics().fDescent - hint_font.getSpacing() / 2, hint_font, hint_paint)
-            t = _get_time_description(time)
-            text_width = hint_font.measureText(t)
-            canvas.drawString(t, - text_width - 10, y + hint_font.getMetrics().fDescent + hint_font.getSpacing() / 2, hint_font, hint_paint)
-        analyzed_lines = analyze_coincident_lines(notes)
-        for time, note_list in analyzed_lines:
-            y = height - self.compute_time_y(time)
-            start_pos = min(x.position for x in note_list)
-            end_pos = max(x.position for x in note_list)
-            canvas.drawLine(start_pos * width, y, end_pos * width, y, line_paint)
+        layout.beat_lines = analyze_beat_lines(self.chart, max_time)
+        layout.beat_line_combos = self.combo_index.combo_before_many(layout.beat_lines)
+        layout.beat_line_y = height - self.compute_time_y_many(layout.beat_lines)
+        layout.beat_line_index = _SpanIndex(layout.beat_line_y)
+        # Coincident Lines
+        layout.coincident_lines = analyze_coincident_lines(notes)
+        layout.coincident_y = height - self.compute_time_y_many([x[0] for x in layout.coincident_lines])
+        layout.coincident_index = _SpanIndex(layout.coincident_y)
+        layout.coincident_timings = set(x[0] for x in layout.coincident_lines)
+        layout.coincident_start = [min(scale_position(x.position) for x in note_list) for _, note_list in layout.coincident_lines]
+        layout.coincident_end = [max(scale_position(x.position) for x in note_list) for _, note_list in layout.coincident_lines]
         # Chart Notes
-        coincident_timings = set(x[0] for x in analyzed_lines)
         notes.sort(key=lambda x: x.time)
-        for note in notes:
+        layout.notes = notes
+        layout.note_y = height - self.compute_time_y_many([x.time for x in notes])
+        layout.note_next_y = height - self.compute_time_y_many([x.next_note.time if x.next_note else x.time for x in notes])
+        layout.note_position = scale_position(np.array([x.position for x in notes], dtype=np.float64))
+        layout.note_next_position = scale_position(np.array([x.next_note.position if x.next_note else x.position for x in notes], dtype=np.float64))
+        # Charge and chain notes span to their next note, so they are found from either end
+        layout.note_index = _SpanIndex(np.minimum(layout.note_y, layout.note_next_y),
+                                       np.maximum(layout.note_y, layout.note_next_y))
+        # Note Beat Text Hint
+        layout.beats = analyze_beats(notes)
+        layout.beat_y = height - self.compute_time_y_many([x[0] for x in layout.beats])
+        layout.beat_index = _SpanIndex(layout.beat_y)
+        # Speed Change / BPM Change Text Hint
+        layout.speed_change_y = height - self.compute_time_y_many([x.time for x in self.speed_changes])
+        layout.speed_change_index = _SpanIndex(layout.speed_change_y)
+        layout.bpm_changes = [x for x in self.chart.notes if x.note_type == 2]
+        layout.bpm_change_y = height - self.compute_time_y_many([x.time for x in layout.bpm_changes])
+        layout.bpm_change_index = _SpanIndex(layout.bpm_change_y)
+        return layout
+
+    def _get_layout(self) -> "_ChartLayout":
+        if self._layout is None:
+            self._layout = self._create_layout()
+        return self._layout
+
+    def _draw_chart(self, canvas: sk.Canvas, layout: "_ChartLayout", top: float, bottom: float,
+                    stats: Optional["RenderStats"] = None, origin: float = 0.0):
+        # Draws every chart element whose extent intersects [top, bottom] in chart coordinates. Chart y is moved up
+        # by origin before it reaches Skia, so strips far down the chart are drawn with small float32 coordinates.
+        import skia as sk
+        base_size = self.config.note_base_size
+        width, height = layout.width, layout.height
+        margin = layout.margin
+        paints = self.paints
+        tap_paint = paints.tap_paint
+        note_stroke_paint = paints.note_stroke_paint
+        note_bold_stroke_paint = paints.note_bold_stroke_paint
+        chain_paint = paints.chain_paint
+        charge_paint = paints.charge_paint
+        charge_segment_paint = paints.charge_segment_paint
+        charge_segment_stroke_paint = paints.charge_segment_stroke_paint
+        chain_connection_paint = paints.chain_connection_paint
+        line_paint = paints.line_paint
+        beat_line_paint = paints.beat_line_paint
+        geometry = self._geometry
+        chain_path = geometry.chain_path
+        # Cached shapes are copied into this path at the note position. Offsetting the points keeps the float
+        # results of the original per-note paths, a canvas translation rounds differently far down the chart.
+        placed_path = sk.Path()
+        paths_created = geometry.paths_created
+        layer_paint = paints.layer_paint
+        # Speed Change Hint
+        visible = layout.speed_rect_index.query(top - margin, bottom + margin)
+        for i in visible:
+            rect_top, rect_bottom = layout.speed_rects[i]
+            canvas.drawRect(sk.Rect(0, rect_top - origin, width, rect_bottom - origin), layer_paint)
+        if stats is not None:
+            stats.add('draw_rect', len(visible))
+            stats.lap('speed_overlay')
+        # Beatline Hint
+        hint_paint = paints.text_paint
+        hint_font = paints.hint_font
+        combo_y = paints.hint_descent - paints.hint_spacing / 2
+        time_y = paints.hint_descent + paints.hint_spacing / 2
+        visible = layout.beat_line_index.query(top - margin, bottom + margin)
+        # Lines of one paint go out in a single call, the labels sit left of the track and never overlap them
+        if visible:
+            canvas.drawPoints(sk.Canvas.kLines_PointMode,
+                              [sk.Point(x, layout.beat_line_y[i] - origin) for i in visible for x in (0, width)],
+                              beat_line_paint)
+        for i in visible:
+            y = layout.beat_line_y[i] - origin
+            combo = str(layout.beat_line_combos[i])
+            canvas.drawString(combo, -hint_font.measureText(combo) - 10, y + combo_y, hint_font, hint_paint)
+            t = _get_time_description(layout.beat_lines[i])
+            canvas.drawString(t, -hint_font.measureText(t) - 10, y + time_y, hint_font, hint_paint)
+        if stats is not None:
+            stats.add('draw_line', 1 if visible else 0)
+            stats.add('draw_text', len(visible) * 2)
+            stats.lap('beat_lines')
+        visible = layout.coincident_index.query(top - margin, bottom + margin)
+        if visible:
+            points = []
+            for i in visible:
+                y = layout.coincident_y[i] - origin
+                points.append(sk.Point(layout.coincident_start[i] * width, y))
+                points.append(sk.Point(layout.coincident_end[i] * width, y))
+            canvas.drawPoints(sk.Canvas.kLines_PointMode, points, line_paint)
+        if stats is not None:
+            stats.add('draw_line', 1 if visible else 0)
+            stats.lap('coincident_lines')
+        # Chart Notes
+        # Notes stay one draw call per shape, batching them by paint would change how overlapping notes stack
+        coincident_timings = layout.coincident_timings
+        visible = layout.note_index.query(top - margin, bottom + margin)
+        for i in visible:
+            note = layout.notes[i]
+            y = layout.note_y[i] - origin
+            position = layout.note_position[i]
             if note.is_tap_note():
                 note_width = width * note.width * self.config.width_scale if note.is_wide_note() else base_size * 2
-                y = height - self.compute_time_y(note.time)
-                rect = sk.Rect(width * note.position - note_width / 2, y - base_size,
-                               width * note.position + note_width / 2, y + base_size)
+                rect = sk.Rect(width * position - note_width / 2, y - base_size,
+                               width * position + note_width / 2, y + base_size)
                 canvas.drawRoundRect(rect, base_size, base_size, tap_paint)
                 canvas.drawRoundRect(rect, base_size, base_size,
                                      note_bold_stroke_paint if note.time in coincident_timings else note_stroke_paint)
             elif note.is_chain_note(0):
                 if note.next_note:
-                    start_x, start_y = width * note.position, height - self.compute_time_y(note.time)
-                    end_x, end_y = width * note.next_note.position, height - self.compute_time_y(note.next_note.time)
+                    start_x, start_y = width * position, y
+                    end_x, end_y = width * layout.note_next_position[i], layout.note_next_y[i] - origin
                     canvas.drawLine(start_x, start_y, end_x, end_y, chain_connection_paint)
-                chain_path.offset(width * note.position, height - self.compute_time_y(note.time))
-                canvas.drawPath(chain_path, chain_paint)
-                canvas.drawPath(chain_path,
+                chain_path.offset(width * position, y, placed_path)
+                canvas.drawPath(placed_path, chain_paint)
+                canvas.drawPath(placed_path,
                                 note_bold_stroke_paint if note.time in coincident_timings else note_stroke_paint)
-                chain_path.offset(-width * note.position, -(height - self.compute_time_y(note.time)))
             elif note.is_long_note():
                 note_width = width * note.width * self.config.width_scale if note.is_wide_note() else base_size * 2
                 if note.next_note:
-                    start_x, start_y = width * note.position, height - self.compute_time_y(note.time)
-                    end_x, end_y = width * note.next_note.position, height - self.compute_time_y(note.next_note.time)
+                    start_x, start_y = width * position, y
+                    end_x, end_y = width * layout.note_next_position[i], layout.note_next_y[i] - origin
                     path = sk.Path()
                     path.moveTo(start_x - note_width / 2, start_y)
                     path.lineTo(start_x + note_width / 2, start_y)
@@ -238,51 +425,98 @@ class ChainbeetRenderer:
                     path.close()
                     canvas.drawPath(path, charge_segment_paint)
                     canvas.drawPath(path, charge_segment_stroke_paint)
-                charge_path = _create_charge_path(note_width, base_size)
-                charge_path.offset(width * note.position, height - self.compute_time_y(note.time))
-                canvas.drawPath(charge_path, charge_paint)
-                canvas.drawPath(charge_path,
+                charge_path = geometry.charge_path(note_width)
+                charge_path.offset(width * position, y, placed_path)
+                canvas.drawPath(placed_path, charge_paint)
+                canvas.drawPath(placed_path,
                                 note_bold_stroke_paint if note.time in coincident_timings else note_stroke_paint)
-                charge_path.offset(-width * note.position, -(height - self.compute_time_y(note.time)))
+        if stats is not None:
+            # placed_path plus the charge shapes first seen in this pass
+            stats.add('paths_created', geometry.paths_created - paths_created + 1)
+            for i in visible:
+                note = layout.notes[i]
+                if note.is_tap_note():
+                    stats.add('draw_rect', 2)
+                elif note.is_chain_note(0):
+                    stats.add('draw_path', 2)
+                    stats.add('draw_line', 1 if note.next_note else 0)
+                elif note.is_long_note():
+                    stats.add('paths_created', 1 if note.next_note else 0)
+                    stats.add('draw_path', 4 if note.next_note else 2)
+            stats.lap('notes')
         # Note Beat Text Hint
-        text_paint = sk.Paint(Color=0xffffffff)
-        text_font = sk.Font()
-        text_font.setSize(20)
-        for time, split in analyze_beats(notes):
-            y = height - self.compute_time_y(time)
-            x = width + 10
-            canvas.drawString(str(split), x, y + text_font.getMetrics().fDescent, text_font, text_paint)
+        text_paint = paints.text_paint
+        text_font = paints.beat_font
+        visible = layout.beat_index.query(top - margin, bottom + margin)
+        for i in visible:
+            y = layout.beat_y[i] - origin
+            canvas.drawTextBlob(geometry.text_blob(str(layout.beats[i][1]), text_font), width + 10,
+                                y + paints.beat_descent, text_paint)
         # Speed Change Text Hint
-        text_font.setSize(16)
-        for i in range(len(self.speed_changes)):
-            y = height - self.compute_time_y(self.speed_changes[i].time)
+        text_font = paints.change_font
+        text_count = len(visible)
+        visible = layout.speed_change_index.query(top - margin, bottom + margin)
+        text_count += len(visible)
+        for i in visible:
+            y = layout.speed_change_y[i] - origin
             text = '{:g}x'.format(self.speed_changes[i].time_scale)
-            canvas.drawString(text, 10, y + text_font.getMetrics().fDescent, text_font, text_paint)
+            canvas.drawTextBlob(geometry.text_blob(text, text_font), 10, y + paints.change_descent, text_paint)
         # BPM Change Text Hint
-        for bpm_change in [x for x in self.chart.notes if x.note_type == 2]:
-            y = height - self.compute_time_y(bpm_change.time)
-            t = str(bpm_change.change_bpm)
+        visible = layout.bpm_change_index.query(top - margin, bottom + margin)
+        text_count += len(visible)
+        for i in visible:
+            y = layout.bpm_change_y[i] - origin
+            t = str(layout.bpm_changes[i].change_bpm)
             text_width = text_font.measureText(t)
-            canvas.drawString(t, width - text_width - 10, y + text_font.getMetrics().fDescent, text_font, text_paint)
+            canvas.drawString(t, width - text_width - 10, y + paints.change_descent, text_font, text_paint)
         # Chart Boundary Lines
-        paint = sk.Paint(Color=0xffffffff)
-        canvas.drawLine(0, 0, 0, height, paint)
-        canvas.drawLine(width, 0, width, height, paint)
-        image: sk.Image = surface.makeImageSnapshot()
-        # Split chart to pages
-        info_height = 40
-        height_limit = self.config.page_height
-        required_page = math.ceil(surface.height() / height_limit)
-        required_width = required_page * surface.width()
-        image_height = height_limit + self.config.top_margin + self.config.bottom_margin + info_height
-        surface_2 = sk.Surface(required_width, image_height)
-        canvas = surface_2.getCanvas()
-        canvas.drawColor(0xff080403)
-        for i in range(required_page):
-            top_y, bottom_y = surface.height() - height_limit * (i + 1), surface.height() - height_limit * i
-            src_rect = sk.Rect(0, top_y, surface.width(), bottom_y)
-            dst_rect = sk.Rect(surface.width() * i, self.config.top_margin, surface.width() * (i + 1), self.config.top_margin + height_limit)
-            canvas.drawImageRect(image, src_rect, dst_rect)
+        paint = paints.boundary_paint
+        canvas.drawLine(0, -origin, 0, height - origin, paint)
+        canvas.drawLine(width, -origin, width, height - origin, paint)
+        if stats is not None:
+            stats.add('draw_text', text_count)
+            stats.add('draw_line', 2)
+            stats.lap('text_hints')
+
+    def _draw_region(self, canvas: sk.Canvas, layout: "_ChartLayout", top_y: int, height: int, padding: int = 0,
+                     stats: Optional["RenderStats"] = None, local: bool = False):
+        # Draws rows [top_y - padding, top_y + height + padding) of the full-height chart surface at the canvas
+        # origin. By default the chart is drawn in full-height coordinates under a canvas translation, which rounds
+        # like render() does. With local=True coordinates are moved to the region before they reach Skia, so the
+        # drawing does not depend on how far down the chart the region is, at the cost of 1px shifts against
+        # render() far down long charts.
+        import skia as sk
+        origin = top_y - padding
+        if local:
+            canvas.clipRect(sk.Rect(0, -origin, layout.surface_width, layout.surface_height - origin))
+        else:
+            canvas.translate(0, -origin)
+            canvas.clipRect(sk.Rect(0, 0, layout.surface_width, layout.surface_height))
+            origin = 0
+        canvas.translate(self.config.width_extra / 2, self.config.height_extra / 2)
+        self._draw_chart(canvas, layout, top_y - padding - self.config.height_extra / 2,
+                         top_y + height + padding - self.config.height_extra / 2, stats, origin)
+
+    def _render_region(self, layout: "_ChartLayout", top_y: int, height: int, padding: int = 0,
+                       stats: Optional["RenderStats"] = None) -> sk.Image:
+        # Rasterizes rows [top_y, top_y + height) of the full-height chart surface. Padding rows are drawn
+        # around the region and cropped, so shapes crossing its edges are not anti-aliased against a clip edge.
+        import skia as sk
+        surface = sk.Surface(layout.surface_width, height + padding * 2)
+        canvas: sk.Canvas = surface.getCanvas()
+        if stats is not None:
+            stats.lap('surface')
+        self._draw_region(canvas, layout, top_y, height, padding, stats)
+        if not padding:
+            return surface.makeImageSnapshot()
+        return surface.makeImageSnapshot(sk.IRect.MakeXYWH(0, padding, layout.surface_width, height))
+
+    def _render_page_strip(self, layout: "_ChartLayout", index: int, stats: Optional["RenderStats"] = None) -> sk.Image:
+        page_height = self.config.page_height
+        return self._render_region(layout, layout.surface_height - page_height * (index + 1), page_height,
+                                   _STRIP_PADDING, stats)
+
+    def _draw_info(self, canvas: sk.Canvas, layout: "_ChartLayout"):
         # Draw Infomation
         renderer_info = 'Generated by chainbeet-chart-renderer'
         mirror_tip = ' // Mirror Chart ' if self.chart.is_mirror else ''
@@ -290,9 +524,349 @@ class ChainbeetRenderer:
             text = '{} // BaseBPM: {} {} //  {}'.format(self.chart_name, self.chart.bpm, mirror_tip, renderer_info)
         else:
             text = 'BaseBPM: {}  // {} {}'.format(self.chart.bpm, mirror_tip, renderer_info)
-        text_font = self.text_font or sk.Font()
-        text_font.setSize(40)
-        text_y = height_limit + self.config.top_margin + self.config.bottom_margin / 2 + 25
+        text_paint = self.paints.text_paint
+        if self.text_font:
+            text_font = self.text_font
+            text_font.setSize(40)
+        else:
+            text_font = self.paints.info_font
+        text_y = self.config.page_height + self.config.top_margin + self.config.bottom_margin / 2 + 25
         canvas.drawString(text, self.config.width_extra / 2, text_y, text_font, text_paint)
-        image = surface_2.makeImageSnapshot()
+
+    def _split_pages(self, layout: "_ChartLayout", image: Optional[sk.Image],
+                     stats: Optional["RenderStats"] = None) -> sk.Image:
+        # Lays the full-height chart image out as pages, or renders page strips one by one when image is None
+        import skia as sk
+        height_limit = self.config.page_height
+        surface = sk.Surface(layout.page_count * layout.surface_width, layout.image_height)
+        canvas = surface.getCanvas()
+        canvas.drawColor(_BACKGROUND_COLOR)
+        if image is None:
+            for i in range(layout.page_count):
+                canvas.drawImage(self._render_page_strip(layout, i, stats), layout.surface_width * i, self.config.top_margin)
+                if stats is not None:
+                    stats.lap('page_split')
+        else:
+            for i in range(layout.page_count):
+                top_y, bottom_y = layout.surface_height - height_limit * (i + 1), layout.surface_height - height_limit * i
+                src_rect = sk.Rect(0, top_y, layout.surface_width, bottom_y)
+                dst_rect = sk.Rect(layout.surface_width * i, self.config.top_margin, layout.surface_width * (i + 1), self.config.top_margin + height_limit)
+                canvas.drawImageRect(image, src_rect, dst_rect)
+        self._draw_info(canvas, layout)
+        image = surface.makeImageSnapshot()
+        if stats is not None:
+            stats.add('draw_image', layout.page_count)
+            stats.add('draw_text', 1)
+            stats.lap('page_split')
+        return image
+
+    def render(self, tiled: bool = False, stats: Optional["RenderStats"] = None) -> sk.Image:
+        # With tiled=True each page is rasterized on its own instead of from one full-height surface, which bounds
+        # peak memory to a single page plus the output. Every strip is clipped and anti-aliased on its own, so shape
+        # edges may differ from the full-height render by up to about 55 levels on individual pixels (see README).
+        # Pass a RenderStats, or set on_stats, to collect per-stage timings and draw call counts.
+        if stats is None and self.on_stats is not None:
+            stats = RenderStats()
+        if stats is not None:
+            stats.restart()
+        layout = self._get_layout()
+        if stats is not None:
+            stats.lap('layout')
+        if tiled:
+            image = self._split_pages(layout, None, stats)
+        else:
+            image = self._split_pages(layout, self._render_region(layout, 0, layout.surface_height, stats=stats), stats)
+        if stats is not None and self.on_stats is not None:
+            self.on_stats(stats)
         return image
+
+    def page_time_range(self, index: int) -> tuple[float, float]:
+        # Times at the bottom and top edge of a page, limited to the chart
+        layout = self._get_layout()
+        bottom_y = self.config.page_height * index - self.config.height_extra / 2
+        return (max(0.0, self.compute_y_time(bottom_y)),
+                min(layout.max_time, self.compute_y_time(bottom_y + self.config.page_height)))
+
+    def render_page_images(self, tiled: bool = False) -> list[sk.Image]:
+        # The pages of render() as separate images
+        import skia as sk
+        if tiled:
+            return list(self.render_pages())
+        layout = self._get_layout()
+        image = self.render()
+        return [image.makeSubset(sk.IRect.MakeXYWH(layout.surface_width * i, 0, layout.surface_width,
+                                                   layout.image_height)) for i in range(layout.page_count)]
+
+    def render_pages(self) -> Iterator[sk.Image]:
+        # Yields the pages of render(tiled=True) one at a time, each cropped to its own column
+        layout = self._get_layout()
+        for i in range(layout.page_count):
+            yield self._compose_page(layout, i, self._render_page_strip(layout, i))
+
+    def _compose_page(self, layout: "_ChartLayout", index: int, strip: sk.Image) -> sk.Image:
+        import skia as sk
+        surface = sk.Surface(layout.surface_width, layout.image_height)
+        canvas = surface.getCanvas()
+        canvas.drawColor(_BACKGROUND_COLOR)
+        canvas.drawImage(strip, 0, self.config.top_margin)
+        canvas.translate(-layout.surface_width * index, 0)
+        self._draw_info(canvas, layout)
+        return surface.makeImageSnapshot()
+
+    def _raw_notes(self, exclude: Optional[Note] = None) -> list[list]:
+        if exclude is not None and not any(x is exclude for x in self.chart.notes):
+            raise ValueError('note is not part of the rendered chart')
+        return [x.raw_info.raw_params for x in self.chart.notes if x is not exclude]
+
+    def _apply_edit(self, raw_notes: list[list], removed: Optional[Note], added: Optional[list]):
+        # Note times, Y, combos and beat lines only depend on what comes earlier in the chart, so BPM and speed
+        # changes ripple forward in time only. Everything drawn before the earliest edited note, or the earliest
+        # note whose charge / chain links the edit rewired, is left as it was. Notes are matched across the
+        # re-parse by their raw entries, which are kept as the same objects.
+        dirty_from = math.inf
+        if removed is not None:
+            dirty_from = min(dirty_from, removed.time)
+        old_links = {id(x.raw_info.raw_params): (x.time, _raw_id(x.prev_note), _raw_id(x.next_note))
+                     for x in self.chart.notes}
+        info = {'bpm': self.chart.bpm, 'dir': self.chart.directory, 'delay': self.chart.delay}
+        self._load_chart(parse_value({'info': info, 'notes': raw_notes}, self.chart.is_mirror))
+        if added is not None:
+            note = next(x for x in self.chart.notes if x.raw_info.raw_params is added)
+            dirty_from = min(dirty_from, note.time)
+        for note in self.chart.notes:
+            old = old_links.get(id(note.raw_info.raw_params))
+            if old is not None and old[1:] != (_raw_id(note.prev_note), _raw_id(note.next_note)):
+                dirty_from = min(dirty_from, note.time, old[0])
+        self._dirty_from = min(self._dirty_from, dirty_from)
+
+    def insert_note(self, raw_note: list):
+        # raw_note is an entry of the chart JSON "notes" list, in unmirrored positions even for mirrored charts
+        self._apply_edit(self._raw_notes() + [raw_note], None, raw_note)
+
+    def delete_note(self, note: Note):
+        # note is one of self.chart.notes, which is replaced by a newly parsed chart after every edit
+        self._apply_edit(self._raw_notes(note), note, None)
+
+    def move_note(self, note: Note, raw_note: list):
+        self._apply_edit(self._raw_notes(note) + [raw_note], note, raw_note)
+
+    def render_changed_pages(self) -> dict[int, sk.Image]:
+        # Pages laid out as render_pages() does, for every page whose drawing changed since the previous call. The
+        # first call returns all pages. Pages are drawn in page-local coordinates so they do not change with the
+        # chart height, far down long charts shapes and text may sit 1px off from render() and render_pages().
+        # Pages above the dirty point are recorded and compared by their recorded draw commands, as ripple from
+        # BPM, speed and combo changes may or may not reach them.
+        import skia as sk
+        layout = self._get_layout()
+        page_height = self.config.page_height
+        first = 0
+        if self._pages and self._dirty_from != -math.inf:
+            if self._dirty_from == math.inf:
+                first = layout.page_count
+            else:
+                # Page i draws nothing above time Y page_height * (i + 1) - height_extra / 2 + padding + margin
+                dirty_y = self.compute_time_y(self._dirty_from)
+                reach = self.config.height_extra / 2 - _STRIP_PADDING - layout.margin
+                first = max(0, int((dirty_y + reach) // page_height) - 1)
+        changed: dict[int, sk.Image] = {}
+        for i in range(layout.page_count):
+            if i < first and i in self._pages:
+                continue
+            recorder = sk.PictureRecorder()
+            canvas = recorder.beginRecording(sk.Rect(0, 0, layout.surface_width, page_height + _STRIP_PADDING * 2))
+            self._draw_region(canvas, layout, layout.surface_height - page_height * (i + 1), page_height, _STRIP_PADDING,
+                              local=True)
+            picture = recorder.finishRecordingAsPicture()
+            digest = hashlib.sha1(bytes(picture.serialize())).digest()
+            if i in self._pages and self._page_digests.get(i) == digest:
+                continue
+            surface = sk.Surface(layout.surface_width, page_height + _STRIP_PADDING * 2)
+            surface.getCanvas().drawPicture(picture)
+            strip = surface.makeImageSnapshot(sk.IRect.MakeXYWH(0, _STRIP_PADDING, layout.surface_width, page_height))
+            self._pages[i] = changed[i] = self._compose_page(layout, i, strip)
+            self._page_digests[i] = digest
+        for i in [x for x in self._pages if x >= layout.page_count]:
+            del self._pages[i]
+            del self._page_digests[i]
+        self._dirty_from = math.inf
+        return changed
+
+    def cached_pages(self) -> list[sk.Image]:
+        # Every page, re-rendering only what changed since the last call
+        self.render_changed_pages()
+        return [self._pages[i] for i in range(len(self._pages))]
+
+    def record_picture(self) -> sk.Picture:
+        # Records the whole chart in full-height surface coordinates once, later outputs only replay it
+        import skia as sk
+        if self._picture is None:
+            layout = self._get_layout()
+            recorder = sk.PictureRecorder()
+            canvas = recorder.beginRecording(sk.Rect(0, 0, layout.surface_width, layout.surface_height))
+            canvas.translate(self.config.width_extra / 2, self.config.height_extra / 2)
+            self._draw_chart(canvas, layout, -math.inf, math.inf)
+            self._picture = recorder.finishRecordingAsPicture()
+        return self._picture
+
+    def _draw_picture_page(self, canvas: sk.Canvas, layout: "_ChartLayout", index: int):
+        import skia as sk
+        page_height = self.config.page_height
+        top_y = layout.surface_height - page_height * (index + 1)
+        canvas.save()
+        canvas.clipRect(sk.Rect(layout.surface_width * index, self.config.top_margin,
+                                layout.surface_width * (index + 1), self.config.top_margin + page_height))
+        canvas.translate(layout.surface_width * index, self.config.top_margin - top_y)
+        canvas.clipRect(sk.Rect(0, 0, layout.surface_width, layout.surface_height))
+        canvas.drawPicture(self.record_picture())
+        canvas.restore()
+
+    def render_from_picture(self, scale: float = 1.0) -> sk.Image:
+        # Same layout as render(), replayed from the recorded picture. A scale below 1 gives a thumbnail. Even at
+        # scale 1 anti-aliasing differs from render(), by up to about 85 levels on individual pixels (see README).
+        import skia as sk
+        layout = self._get_layout()
+        surface = sk.Surface(max(1, round(layout.page_count * layout.surface_width * scale)),
+                             max(1, round(layout.image_height * scale)))
+        canvas = surface.getCanvas()
+        canvas.drawColor(_BACKGROUND_COLOR)
+        canvas.scale(scale, scale)
+        for i in range(layout.page_count):
+            self._draw_picture_page(canvas, layout, i)
+        self._draw_info(canvas, layout)
+        return surface.makeImageSnapshot()
+
+    def render_page(self, index: int, scale: float = 1.0) -> sk.Image:
+        # The index-th page column of render_from_picture()
+        import skia as sk
+        layout = self._get_layout()
+        if not 0 <= index < layout.page_count:
+            raise IndexError('page index out of range: {}'.format(index))
+        surface = sk.Surface(max(1, round(layout.surface_width * scale)), max(1, round(layout.image_height * scale)))
+        canvas = surface.getCanvas()
+        canvas.drawColor(_BACKGROUND_COLOR)
+        canvas.scale(scale, scale)
+        canvas.translate(-layout.surface_width * index, 0)
+        self._draw_picture_page(canvas, layout, index)
+        self._draw_info(canvas, layout)
+        return surface.makeImageSnapshot()
+
+    def render_time_range(self, start_time: float, end_time: float, scale: float = 1.0) -> sk.Image:
+        # The chart between start_time (bottom) and end_time (top) as one unsplit column
+        import skia as sk
+        layout = self._get_layout()
+        top = layout.height - self.compute_time_y(end_time) + self.config.height_extra / 2
+        bottom = layout.height - self.compute_time_y(start_time) + self.config.height_extra / 2
+        surface = sk.Surface(max(1, round(layout.surface_width * scale)), max(1, math.ceil((bottom - top) * scale)))
+        canvas = surface.getCanvas()
+        canvas.drawColor(_BACKGROUND_COLOR)
+        canvas.scale(scale, scale)
+        canvas.translate(0, -top)
+        canvas.clipRect(sk.Rect(0, 0, layout.surface_width, layout.surface_height))
+        canvas.drawPicture(self.record_picture())
+        return surface.makeImageSnapshot()
+
+    def _draw_window(self, canvas: sk.Canvas, layout: "_ChartLayout", bottom_time_y: float, span: float,
+                     width: int, height: int):
+        # Draws time Y [bottom_time_y, bottom_time_y + span] onto the whole height of the canvas, scaled uniformly
+        # with the track centered horizontally
+        scale = height / span
+        top = layout.height - bottom_time_y - span
+        canvas.drawColor(_BACKGROUND_COLOR)
+        canvas.save()
+        canvas.translate((width - layout.surface_width * scale) / 2, 0)
+        canvas.scale(scale, scale)
+        canvas.translate(self.config.width_extra / 2, 0)
+        self._draw_chart(canvas, layout, top, top + span, origin=top)
+        canvas.restore()
+
+    def render_window(self, start_time: float, end_time: float, width: int, height: int) -> sk.Image:
+        # The chart between start_time (bottom) and end_time (top) fitted to a width x height image. Only the
+        # elements crossing the window are looked up and drawn, so the cost does not grow with chart length.
+        import skia as sk
+        if end_time <= start_time:
+            raise ValueError('end_time must be after start_time')
+        layout = self._get_layout()
+        bottom_time_y = self.compute_time_y(start_time)
+        surface = sk.Surface(width, height)
+        self._draw_window(surface.getCanvas(), layout, bottom_time_y, self.compute_time_y(end_time) - bottom_time_y,
+                          width, height)
+        return surface.makeImageSnapshot()
+
+    def render_frames(self, width: int, height: int, fps: float = 60.0, window: float = 2.0, start_time: float = 0.0,
+                      end_time: Optional[float] = None) -> Iterator[sk.Image]:
+        # Scrolling preview frames. Frame k has start_time + k / fps at its bottom edge and shows window seconds
+        # of 1x speed above it, so speed changes alter the scroll rate as they do in game. All frames are drawn
+        # on one surface; an image still held when the next frame is drawn is copied first.
+        import skia as sk
+        layout = self._get_layout()
+        end_time = layout.max_time if end_time is None else end_time
+        span = window * self.config.height_factor
+        surface = sk.Surface(width, height)
+        canvas = surface.getCanvas()
+        for k in range(max(0, math.floor((end_time - start_time) * fps) + 1)):
+            self._draw_window(canvas, layout, self.compute_time_y(start_time + k / fps), span, width, height)
+            yield surface.makeImageSnapshot()
+
+
+class _ChartLayout:
+    width: int
+    height: int
+    max_time: float
+    margin: float
+    surface_width: int
+    surface_height: int
+    page_count: int
+    info_height: int
+    image_height: int
+    speed_rects: list[tuple[float, float]]
+    speed_rect_index: "_SpanIndex"
+    beat_lines: list[float]
+    beat_line_combos: np.ndarray
+    beat_line_y: np.ndarray
+    beat_line_index: "_SpanIndex"
+    coincident_lines: list[tuple[float, list[Note]]]
+    coincident_y: np.ndarray
+    coincident_index: "_SpanIndex"
+    coincident_timings: set[float]
+    coincident_start: list[float]
+    coincident_end: list[float]
+    notes: list[Note]
+    note_y: np.ndarray
+    note_next_y: np.ndarray
+    note_position: np.ndarray
+    note_next_position: np.ndarray
+    note_index: "_SpanIndex"
+    beats: list[tuple[float, int]]
+    beat_y: np.ndarray
+    beat_index: "_SpanIndex"
+    speed_change_y: np.ndarray
+    speed_change_index: "_SpanIndex"
+    bpm_changes: list[Note]
+    bpm_change_y: np.ndarray
+    bpm_change_index: "_SpanIndex"
+
+
+class _SpanIndex:
+    # Vertical extents [lo, hi] of drawn elements, sorted by lo with a running maximum of hi, so the elements
+    # crossing a range are found by binary search instead of a scan over the whole chart.
+    order: np.ndarray
+    lo: np.ndarray
+    hi: np.ndarray
+    max_hi: np.ndarray
+
+    def __init__(self, lo: np.ndarray, hi: Optional[np.ndarray] = None) -> None:
+        hi = lo if hi is None else hi
+        self.order = np.argsort(lo, kind='stable')
+        self.lo = lo[self.order]
+        self.hi = hi[self.order]
+        self.max_hi = np.maximum.accumulate(self.hi) if len(self.hi) else self.hi
+
+    def query(self, top: float, bottom: float) -> list[int]:
+        # Indices of the elements with hi >= top and lo <= bottom, in drawing order
+        start = np.searchsorted(self.max_hi, top, side='left')
+        end = np.searchsorted(self.lo, bottom, side='right')
+        if start >= end:
+            return []
+        found = self.order[start:end][self.hi[start:end] >= top]
+        found.sort()
+        return found.tolist()
@@ -0,0 +1,147 @@
+from cache import RenderCache, render_key
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from parser import parse
+from renderer import ChainbeetRenderer, ChainbeetRenderConfig, ChainbeetPaints
+from typing import Optional
+import asyncio
+import os
+import statistics
+import threading
+import time
+import skia as sk
+
+
+class RenderServiceBusy(Exception):
+    # Raised instead of queueing once max_pending distinct renders are in flight
+    pass
+
+
+_local = threading.local()
+
+
+def _render_png(chart_json: str | bytes, mirror: bool, config: Optional[ChainbeetRenderConfig],
+                chart_name: Optional[str]) -> tuple[bytes, float]:
+    # Runs on a pool worker. Paints are built once per worker thread or process.
+    begin = time.perf_counter()
+    paints = getattr(_local, 'paints', None)
+    if paints is None:
+        paints = _local.paints = ChainbeetPaints()
+    chart = parse(chart_json, mirror)
+    image = ChainbeetRenderer(chart, config, chart_name, paints=paints).render()
+    data = bytes(image.encodeToData(sk.EncodedImageFormat.kPNG, 100))
+    return data, time.perf_counter() - begin
+
+
+def _summarize(samples: deque) -> dict[str, float]:
+    if not samples:
+        return {'count': 0, 'mean': 0.0, 'p50': 0.0, 'p95': 0.0, 'max': 0.0}
+    ordered = sorted(samples)
+    return {
+        'count': len(ordered),
+        'mean': statistics.fmean(ordered),
+        'p50': ordered[len(ordered) // 2],
+        'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        'max': ordered[-1],
+    }
+
+
+class RenderService:
+    # Renders charts to PNG for asyncio code. Parsing, rendering and encoding run on a bounded thread or process
+    # pool, concurrent requests for the same chart, variant and config share one job, and new jobs are refused
+    # with RenderServiceBusy once max_pending are in flight. Skia holds the GIL for much of the drawing, so with
+    # processes=False renders still slow the event loop down; threads suit small charts or a shared cache.
+    workers: int
+    max_pending: int
+    config: ChainbeetRenderConfig
+    cache: Optional[RenderCache]
+
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        max_pending: int = 32,
+        processes: bool = True,
+        config: Optional[ChainbeetRenderConfig] = None,
+        cache: Optional[RenderCache] = None,
+        latency_window: int = 1000
+    ) -> None:
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.config = config or ChainbeetRenderConfig()
+        self.cache = cache
+        self._executor: Executor = (ProcessPoolExecutor if processes else ThreadPoolExecutor)(max_workers=self.workers)
+        self._in_flight: dict[str, asyncio.Future] = {}
+        self._latency: deque[float] = deque(maxlen=latency_window)
+        self._wait: deque[float] = deque(maxlen=latency_window)
+        self._render: deque[float] = deque(maxlen=latency_window)
+        self._counts = {'requests': 0, 'coalesced': 0, 'rejected': 0, 'cache_hits': 0, 'rendered': 0, 'failed': 0}
+
+    async def render(
+        self,
+        chart_json: str | bytes,
+        mirror: bool = False,
+        chart_name: Optional[str] = None,
+        config: Optional[ChainbeetRenderConfig] = None
+    ) -> bytes:
+        config = config or self.config
+        begin = time.perf_counter()
+        self._counts['requests'] += 1
+        key = render_key(chart_json, mirror, config, chart_name)
+        job = self._in_flight.get(key)
+        if job is not None:
+            self._counts['coalesced'] += 1
+        else:
+            if len(self._in_flight) >= self.max_pending:
+                self._counts['rejected'] += 1
+                raise RenderServiceBusy('{} renders already pending'.format(len(self._in_flight)))
+            job = self._in_flight[key] = asyncio.ensure_future(self._run(key, chart_json, mirror, config, chart_name))
+            job.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # A cancelled request must not cancel the job other requests are waiting on
+        data = await asyncio.shield(job)
+        self._latency.append(time.perf_counter() - begin)
+        return data
+
+    async def _run(self, key: str, chart_json: str | bytes, mirror: bool, config: ChainbeetRenderConfig,
+                   chart_name: Optional[str]) -> bytes:
+        loop = asyncio.get_running_loop()
+        if self.cache is not None:
+            cached = await loop.run_in_executor(None, self.cache.get, key, False)
+            if cached is not None:
+                self._counts['cache_hits'] += 1
+                return cached.image
+        submitted = time.perf_counter()
+        try:
+            data, seconds = await loop.run_in_executor(self._executor, _render_png, chart_json, mirror, config,
+                                                       chart_name)
+        except Exception:
+            self._counts['failed'] += 1
+            raise
+        self._counts['rendered'] += 1
+        self._render.append(seconds)
+        self._wait.append(max(0.0, time.perf_counter() - submitted - seconds))
+        if self.cache is not None:
+            await loop.run_in_executor(None, self.cache.put, key, data)
+        return data
+
+    def metrics(self) -> dict:
+        # Queue depth counts jobs waiting for a free worker, latencies are in seconds over the recent window
+        in_flight = len(self._in_flight)
+        return {
+            'in_flight': in_flight,
+            'queue_depth': max(0, in_flight - self.workers),
+            'max_pending': self.max_pending,
+            'workers': self.workers,
+            **self._counts,
+            'latency': _summarize(self._latency),
+            'queue_wait': _summarize(self._wait),
+            'render': _summarize(self._render),
+        }
+
+    def close(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+    async def __aenter__(self) -> "RenderService":
+        return self
+
+    async def __aexit__(self, *args):
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
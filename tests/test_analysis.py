@@ -0,0 +1,225 @@
+from analysis import analyze_beat_lines, analyze_beats, analyze_chart, analyze_coincident_lines
+from benchmark import PRESETS, ChartSpec, generate_chart
+from parser import Note, NoteInfo, NoteRawInfo, parse, parse_columns
+from typing import Optional
+import json
+import os
+import random
+import pytest
+
+ASSETS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'assets')
+
+
+# Loop implementations the vectorized functions replaced, kept verbatim as the reference
+
+
+def reference_analyze_beat_lines(chart: NoteInfo, max_time: Optional[float] = None) -> list[float]:
+    bpm_changes = [x for x in chart.notes if x.note_type == 2]
+    max_time = max(x.time for x in chart.notes) if max_time is None else max_time
+    curr_bpm = chart.bpm
+    curr_time = 0.0
+    timings: list[float] = []
+    curr_index = 0
+    while True:
+        limit_time = max_time if curr_index >= len(bpm_changes) else bpm_changes[curr_index].time
+        delta_time = 60 / curr_bpm * 4
+        while curr_time + delta_time < limit_time:
+            curr_time += delta_time
+            timings.append(curr_time)
+        if curr_index < len(bpm_changes):
+            curr_bpm = bpm_changes[curr_index].change_bpm
+            timings.append(bpm_changes[curr_index].time)
+            curr_time = bpm_changes[curr_index].time
+        else:
+            break
+        curr_index += 1
+    return timings
+
+
+def reference_analyze_coincident_lines(notes: list[Note]) -> list[tuple[float, list[Note]]]:
+    timings: dict[float, list[Note]] = {}
+    for note in notes:
+        if note.is_meta_note():
+            continue
+        if note.time not in timings:
+            timings[note.time] = []
+        timings[note.time].append(note)
+    result: list[tuple[float, list[Note]]] = []
+    for time, note_list in timings.items():
+        if len(note_list) < 2:
+            continue
+        note_list.sort(key=lambda x: x.position)
+        result.append((time, note_list))
+    return result
+
+
+def reference_analyze_beats(notes: list) -> list[tuple[float, int]]:
+    timings: list[float] = []
+    timing_bpm: dict[float, float] = {}
+    for note in notes:
+        if note.is_meta_note():
+            continue
+        timings.append(note.time)
+        timing_bpm[note.time] = note.bpm
+    timings = sorted(list(set(timings)))
+    result: list[tuple[float, int]] = []
+    error_tolerance: float = 0.05
+    for i in range(len(timings)):
+        curr = timings[i]
+        time_delta = 60.0 / timing_bpm[curr] * 4
+        beat = 0
+        if i < len(timings) - 1:
+            nxt = time_delta / (timings[i + 1] - curr)
+            if abs(nxt - round(nxt)) < error_tolerance:
+                beat = max(beat, round(nxt))
+        if beat % 2 == 0 and beat:
+            result.append((curr, beat))
+    return result
+
+
+def _chart_sources() -> list[tuple[str, str]]:
+    with open(os.path.join(ASSETS, 'gengaozo.json'), 'r', encoding='utf-8') as f:
+        sources = [('gengaozo', f.read())]
+    sources += [(name, json.dumps(generate_chart(spec))) for name, spec in PRESETS.items()]
+    for seed in range(30):
+        rng = random.Random(seed)
+        spec = ChartSpec('seed-{}'.format(seed), seed=seed, notes=rng.randint(50, 1500),
+                         bpm_changes=rng.randint(0, 12), speed_changes=rng.randint(0, 20),
+                         charge_groups=rng.randint(1, 20), chain_groups=rng.randint(1, 40),
+                         duration=rng.uniform(20.0, 240.0), bpm=rng.choice((90.0, 128.0, 150.0, 174.5, 222.0)))
+        sources.append((spec.name, json.dumps(generate_chart(spec))))
+    return sources
+
+
+CHARTS = _chart_sources()
+
+
+def assert_same(actual, expected):
+    # Equal values of the same Python types, so numpy scalars leaking out are caught as well
+    assert type(actual) is type(expected)
+    if isinstance(actual, (list, tuple)):
+        assert len(actual) == len(expected)
+        for x, y in zip(actual, expected):
+            assert_same(x, y)
+    elif isinstance(actual, Note):
+        assert actual is expected
+    else:
+        assert actual == expected
+
+
+def _to_indices(lines: list[tuple[float, list[Note]]], notes: list[Note]) -> list[tuple[float, list[int]]]:
+    index = {id(x): i for i, x in enumerate(notes)}
+    return [(time, [index[id(x)] for x in line]) for time, line in lines]
+
+
+@pytest.fixture(params=CHARTS, ids=[x[0] for x in CHARTS])
+def chart_json(request) -> str:
+    return request.param[1]
+
+
+@pytest.fixture(params=[False, True], ids=['normal', 'mirror'])
+def mirror(request) -> bool:
+    return request.param
+
+
+def test_beat_lines(chart_json, mirror):
+    chart = parse(chart_json, mirror)
+    assert_same(analyze_beat_lines(chart), reference_analyze_beat_lines(chart))
+    end = max(x.time for x in chart.notes) + 13.7
+    assert_same(analyze_beat_lines(chart, end), reference_analyze_beat_lines(chart, end))
+    columns = parse_columns(chart_json, mirror)
+    assert_same(analyze_beat_lines(columns), reference_analyze_beat_lines(chart))
+    assert_same(analyze_beat_lines(columns, end), reference_analyze_beat_lines(chart, end))
+
+
+def test_coincident_lines(chart_json, mirror):
+    chart = parse(chart_json, mirror)
+    assert_same(analyze_coincident_lines(chart.notes), reference_analyze_coincident_lines(chart.notes))
+    shuffled = list(chart.notes)
+    random.Random(len(shuffled)).shuffle(shuffled)
+    assert_same(analyze_coincident_lines(shuffled), reference_analyze_coincident_lines(shuffled))
+    # ChartColumns lines hold note indices in parse order
+    columns = parse_columns(chart_json, mirror)
+    expected = _to_indices(reference_analyze_coincident_lines(chart.notes), chart.notes)
+    assert_same(analyze_coincident_lines(columns), expected)
+
+
+def test_beats(chart_json, mirror):
+    chart = parse(chart_json, mirror)
+    assert_same(analyze_beats(chart.notes), reference_analyze_beats(chart.notes))
+    shuffled = list(chart.notes)
+    random.Random(len(shuffled)).shuffle(shuffled)
+    assert_same(analyze_beats(shuffled), reference_analyze_beats(shuffled))
+    assert_same(analyze_beats(parse_columns(chart_json, mirror)), reference_analyze_beats(chart.notes))
+
+
+def _tap(time: float, bpm: float, position: float = 0.5) -> Note:
+    return Note(10, position, time, bpm, None, None, NoteRawInfo(0, 7, 4, 3, 0, 10, [0, 7, 4, 3, 0, 10]))
+
+
+# At 48 BPM a bar is exactly 5 seconds, so the ratios below are exact up to the gap between two timings
+@pytest.mark.parametrize('gap, expected', [
+    (2.5, 2),      # exact
+    (5 / 4.04, 4),  # inside the tolerance above
+    (5 / 3.96, 4),  # inside the tolerance below
+    (5 / 4.049, 4),
+    (5 / 4.06, 0),  # outside the tolerance
+    (5 / 3.94, 0),
+    (2.0, 0),      # 2.5, rounds half to even but is outside the tolerance
+    (5 / 3.5, 0),  # 3.5, rounds half to even but is outside the tolerance
+    (5 / 6.5, 0),
+    (5 / 3, 0),    # odd beats are dropped
+    (5 / 8, 8),
+    (5 / 2.96, 0),
+])
+def test_beats_tolerance(gap, expected):
+    notes = [_tap(10.0, 48.0), _tap(10.0 + gap, 48.0)]
+    result = analyze_beats(notes)
+    assert_same(result, reference_analyze_beats(notes))
+    assert result == ([(10.0, expected)] if expected else [])
+
+
+def test_beats_half_to_even():
+    # Ratios just inside the tolerance either side of a half, round() and np.rint agree on all of them
+    notes = [_tap(0.0, 60.0)]
+    for ratio in (1.96, 2.04, 2.5, 3.5, 4.5, 5.96, 6.04, 7.5, 8.04):
+        notes.append(_tap(notes[-1].time + 4.0 / ratio, 60.0))
+    assert_same(analyze_beats(notes), reference_analyze_beats(notes))
+
+
+def test_beats_last_bpm_wins():
+    # Notes sharing a timing take the BPM of the last one
+    notes = [_tap(0.0, 60.0, 0.0), _tap(0.0, 120.0, 1.0), _tap(1.0, 60.0)]
+    assert_same(analyze_beats(notes), reference_analyze_beats(notes))
+    assert analyze_beats(notes) == [(0.0, 2)]
+
+
+def test_coincident_position_ties():
+    notes = [_tap(1.0, 60.0, 0.5), _tap(1.0, 60.0, 0.0), _tap(1.0, 60.0, 0.5), _tap(2.0, 60.0), _tap(0.5, 60.0),
+             _tap(0.5, 60.0, 1.0)]
+    assert_same(analyze_coincident_lines(notes), reference_analyze_coincident_lines(notes))
+
+
+def test_empty():
+    assert_same(analyze_beats([]), reference_analyze_beats([]))
+    assert_same(analyze_coincident_lines([]), reference_analyze_coincident_lines([]))
+    single = [_tap(1.0, 60.0)]
+    assert_same(analyze_beats(single), reference_analyze_beats(single))
+    assert_same(analyze_coincident_lines(single), reference_analyze_coincident_lines(single))
+
+
+def test_chart_stats_changes_at_start():
+    # BPM and speed changes at time 0 replace the initial values rather than adding empty bars and segments
+    chart_json = json.dumps({'info': {'bpm': 60}, 'notes': [
+        [0, 4, 4, 0, 0, 2, 120], [0, 4, 4, 0, 0, 3, 2], [0, 4, 4, 1, 0, 10], [1, 4, 4, 1, 0, 10], [1, 4, 4, 2, 2, 10],
+        [2, 4, 4, 1, 0, 10], [4, 4, 4, 0, 0, 2, 240], [4, 4, 4, 0, 0, 2, 60], [4, 4, 4, 1, 0, 10]]})
+    for chart in (parse(chart_json), parse_columns(chart_json)):
+        stats = analyze_chart(chart)
+        assert stats.bar_times == [0.0, 2.0, 4.0, 6.0, 8.0]
+        assert stats.notes_per_bar == [1, 2, 1, 0, 1]
+        assert stats.combo_at_bar == [0, 1, 3, 4, 4]
+        assert stats.bpm_segments == [(0.0, 120.0), (8.0, 60.0)]
+        assert stats.speed_segments == [(0.0, 2.0)]
+    stats = analyze_chart(parse(json.dumps({'info': {'bpm': 60}, 'notes': [[0, 4, 4, 1, 0, 10], [1, 4, 4, 1, 0, 10]]})))
+    assert stats.bar_times == [0.0] and stats.notes_per_bar == [2]
+    assert stats.bpm_segments == [(0.0, 60.0)] and stats.speed_segments == [(0.0, 1.0)]
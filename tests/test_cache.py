@@ -0,0 +1,41 @@
+from cache import RenderCache
+import os
+import random
+
+ASSETS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'assets')
+
+
+def _cached(tmp_path) -> tuple[RenderCache, str, bytes]:
+    with open(os.path.join(ASSETS, 'gengaozo.json'), 'r', encoding='utf-8') as f:
+        chart_json = f.read()
+    cache = RenderCache(str(tmp_path))
+    key = cache.render(chart_json).key
+    with open(cache._chart_path(key), 'rb') as f:
+        return cache, key, f.read()
+
+
+def test_chart_round_trip(tmp_path):
+    cache, key, _ = _cached(tmp_path)
+    cached = cache.get(key)
+    assert cached is not None and cached.chart is not None
+    assert all(x.next_note is None or x.next_note.prev_note is x for x in cached.chart.notes)
+
+
+def test_corrupt_chart_file(tmp_path):
+    cache, key, data = _cached(tmp_path)
+    image = cache.get(key, load_chart=False).image
+    rng = random.Random(0)
+    corrupted = [b'', data[:len(data) // 2], data[:-1], b'not a pickle']
+    for _ in range(200):
+        flipped = bytearray(data)
+        for _ in range(rng.randint(1, 8)):
+            flipped[rng.randrange(len(flipped))] ^= 1 << rng.randrange(8)
+        corrupted.append(bytes(flipped))
+    for i, chart_data in enumerate(corrupted):
+        with open(cache._chart_path(key), 'wb') as f:
+            f.write(chart_data)
+        cached = cache.get(key)
+        assert cached is not None and cached.image == image
+        # A flipped bit in a float or string field may still unpickle, truncated files never do
+        if i < 4:
+            assert cached.chart is None
@@ -0,0 +1,86 @@
+from benchmark import PRESETS, generate_chart
+from parser import Note, NoteInfo, parse
+import chartfile
+import io
+import json
+import os
+import pytest
+
+ASSETS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'assets')
+
+
+def _chart_sources() -> list[tuple[str, str]]:
+    with open(os.path.join(ASSETS, 'gengaozo.json'), 'r', encoding='utf-8') as f:
+        sources = [('gengaozo', f.read())]
+    sources += [(name, json.dumps(generate_chart(spec))) for name, spec in PRESETS.items()]
+    # Raw fields beyond int16, arguments of every kind and a chart without a directory
+    sources.append(('wide', json.dumps({'info': {'bpm': 120.5, 'delay': -3}, 'notes': [
+        [0, 2, 1, 0, 0, 1, 'bgm'], [1, 4, 4, 1, 0, 10], [40000, 4, 4, 2, 1, 10], [2, 4, 4, 0, 0, 2, 90],
+        [3, 4, 4, 0, 0, 3, 1.5], [4, 4, 4, 1, 0, 40, 0.3], [5, 4, 4, 1, 0, 50, 7, 0.5], [6, 4, 4, 1, 0, 51, 7, None],
+        [7, 4, 4, 3, 0, 10, True], [7, 70000, 4, 3, 0, 10]]})))
+    return sources
+
+
+CHARTS = _chart_sources()
+
+
+def _note_fields(note: Note) -> tuple:
+    fields = tuple(getattr(note, name) for name in ('note_type', 'position', 'time', 'bpm', 'file', 'group',
+                                                    'change_bpm', 'width', 'time_scale'))
+    raw = note.raw_info
+    return fields, tuple(type(x) for x in fields), tuple(raw), tuple(type(x) for x in raw.raw_params)
+
+
+def assert_same_chart(actual: NoteInfo, expected: NoteInfo):
+    assert (actual.bpm, actual.directory, actual.delay, actual.is_mirror) == \
+        (expected.bpm, expected.directory, expected.delay, expected.is_mirror)
+    assert len(actual.notes) == len(expected.notes)
+    actual_index = {id(x): i for i, x in enumerate(actual.notes)}
+    expected_index = {id(x): i for i, x in enumerate(expected.notes)}
+    for x, y in zip(actual.notes, expected.notes):
+        assert _note_fields(x) == _note_fields(y)
+        assert actual_index.get(id(x.prev_note)) == expected_index.get(id(y.prev_note))
+        assert actual_index.get(id(x.next_note)) == expected_index.get(id(y.next_note))
+
+
+@pytest.fixture(params=CHARTS, ids=[x[0] for x in CHARTS])
+def chart_json(request) -> str:
+    return request.param[1]
+
+
+@pytest.mark.parametrize('mirror', [False, True], ids=['normal', 'mirror'])
+def test_load_matches_parse(chart_json, mirror, tmp_path):
+    expected = parse(chart_json, mirror)
+    json_path = str(tmp_path / 'chart.json')
+    with open(json_path, 'w', encoding='utf-8') as f:
+        f.write(chart_json)
+    binary_path = str(tmp_path / ('chart' + chartfile.EXTENSION))
+    chartfile.convert(json_path, binary_path)
+    with open(binary_path, 'rb') as f:
+        data = f.read()
+    assert_same_chart(chartfile.load(json_path, mirror), expected)
+    assert_same_chart(chartfile.load(io.StringIO(chart_json), mirror), expected)
+    assert_same_chart(chartfile.load(io.BytesIO(chart_json.encode('utf-8')), mirror), expected)
+    assert_same_chart(chartfile.load(binary_path, mirror), expected)
+    assert_same_chart(chartfile.load(io.BytesIO(data), mirror), expected)
+    assert_same_chart(chartfile.loads(data, mirror).note_info(), expected)
+
+
+def test_raw_width():
+    # Raw fields are only widened to int32 for charts that need it, flags follow magic and version
+    narrow = chartfile.dumps(chartfile.load_columns(io.StringIO(CHARTS[0][1])))
+    wide = chartfile.dumps(chartfile.load_columns(io.StringIO(CHARTS[-1][1])))
+    assert not narrow[6] & chartfile.FLAG_WIDE_RAW
+    assert wide[6] & chartfile.FLAG_WIDE_RAW
+
+
+def test_invalid_files():
+    data = chartfile.dumps(chartfile.load_columns(io.StringIO(CHARTS[0][1])))
+    with pytest.raises(chartfile.ChartFileError):
+        chartfile.loads(data[:len(data) // 2])
+    with pytest.raises(chartfile.ChartFileError):
+        chartfile.loads(data[:10])
+    with pytest.raises(chartfile.ChartFileError):
+        chartfile.loads(data[:4] + b'\x01\x00' + data[6:])
+    with pytest.raises(chartfile.ChartFileError):
+        chartfile.loads(b'XXXX' + data[4:])
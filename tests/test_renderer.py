@@ -0,0 +1,86 @@
+from benchmark import PRESETS, generate_chart
+from parser import parse, parse_value
+from renderer import ChainbeetRenderer
+import json
+import os
+import numpy as np
+
+ASSETS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'assets')
+
+
+def _note_state(chart) -> list[tuple]:
+    return [(x.note_type, x.position, x.time, x.bpm, x.width, x.group, x.prev_note, x.next_note) for x in chart.notes]
+
+
+def test_render_is_repeatable():
+    # Rendering must leave the parsed chart untouched, so it can be rendered again or shared between renderers
+    with open(os.path.join(ASSETS, 'gengaozo.json'), 'r', encoding='utf-8') as f:
+        chart_json = f.read()
+    for mirror in (False, True):
+        chart = parse(chart_json, mirror)
+        before = _note_state(chart)
+        renderer = ChainbeetRenderer(chart)
+        first = renderer.render().toarray()
+        second = renderer.render().toarray()
+        third = ChainbeetRenderer(chart).render().toarray()
+        assert _note_state(chart) == before
+        assert np.array_equal(first, second)
+        assert np.array_equal(first, third)
+        assert np.array_equal(first, ChainbeetRenderer(parse(chart_json, mirror)).render().toarray())
+
+
+def _assert_pages_match_fresh(renderer: ChainbeetRenderer):
+    renderer.render_changed_pages()
+    raw_notes = [x.raw_info.raw_params for x in renderer.chart.notes]
+    info = {'bpm': renderer.chart.bpm, 'dir': renderer.chart.directory, 'delay': renderer.chart.delay}
+    fresh = ChainbeetRenderer(parse_value({'info': info, 'notes': list(raw_notes)}, renderer.chart.is_mirror))
+    pages, expected = renderer.cached_pages(), fresh.cached_pages()
+    assert len(pages) == len(expected)
+    for page, expected_page in zip(pages, expected):
+        assert np.array_equal(page.toarray(), expected_page.toarray())
+
+
+def test_incremental_edits_relink_groups():
+    # A new charge head in an existing group takes over the end note, so the old head's segment must be redrawn
+    # even though it lies pages before the edit
+    chart = {'info': {'bpm': 60}, 'notes': [[0, 7, 4, 3, 0, 20, 0], [10, 7, 4, 3, 0, 21, 0], [12, 7, 4, 1, 0, 10]]}
+    renderer = ChainbeetRenderer(parse(json.dumps(chart)))
+    renderer.cached_pages()
+    renderer.insert_note([9, 7, 4, 5, 0, 20, 0])
+    _assert_pages_match_fresh(renderer)
+    renderer.delete_note(next(x for x in renderer.chart.notes if x.raw_info.beat_plus == 9))
+    _assert_pages_match_fresh(renderer)
+    end = next(x for x in renderer.chart.notes if x.note_type == 21)
+    renderer.move_note(end, [4, 7, 4, 6, 0, 21, 0])
+    _assert_pages_match_fresh(renderer)
+
+
+def test_incremental_edits():
+    for mirror in (False, True):
+        renderer = ChainbeetRenderer(parse(json.dumps(generate_chart(PRESETS['small'])), mirror))
+        renderer.cached_pages()
+        notes = renderer.chart.notes
+        tap = [x for x in notes if x.note_type == 10][len(notes) // 2]
+        renderer.delete_note(tap)
+        _assert_pages_match_fresh(renderer)
+        tap = [x for x in renderer.chart.notes if x.note_type == 10][-3]
+        raw = tap.raw_info
+        renderer.move_note(tap, [raw.beat_plus, raw.position_split, raw.beat_split, 0, raw.beat_idx, 10])
+        _assert_pages_match_fresh(renderer)
+        last = max(x.raw_info.beat_plus for x in renderer.chart.notes)
+        renderer.insert_note([last // 2, 2, 4, 0, 0, 2, 200.0])
+        _assert_pages_match_fresh(renderer)
+        renderer.insert_note([last - 3, 2, 4, 0, 0, 3, 2])
+        _assert_pages_match_fresh(renderer)
+        # Removing a chain middle note links its neighbours directly
+        chain = [x for x in renderer.chart.notes if x.note_type == 31]
+        renderer.delete_note(chain[len(chain) // 3])
+        _assert_pages_match_fresh(renderer)
+        # A second chain head in a group starts a new chain from that point on
+        head = next(x for x in renderer.chart.notes if x.note_type == 30 and x.next_note and x.next_note.next_note)
+        middle = head.next_note.raw_info
+        renderer.insert_note([middle.beat_plus, middle.position_split, middle.beat_split, 0, middle.beat_idx, 30,
+                              head.group])
+        _assert_pages_match_fresh(renderer)
+        renderer.insert_note([last + 5, 4, 4, 1, 0, 10])
+        _assert_pages_match_fresh(renderer)